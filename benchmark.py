@@ -0,0 +1,170 @@
+import pandas as pd
+import numpy as np
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+from datetime import datetime
+
+"""
+Benchmarks of loading, querying and drawing on synthetic data (see synthetic.py).
+Results are appended to a JSON lines file together with the git commit, such that runs on
+different commits can be compared with compare_runs.
+
+Usage: python benchmark.py --preset small --root ./synthetic_data --out benchmarks.jsonl
+"""
+
+def _commit():
+    """Current git commit, "unknown" outside a git repository"""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def timeit(function, repeat=3, setup=None):
+    """Best wall time of a function over a few runs
+
+    Args:
+    - function: callable without arguments
+    - repeat: number of runs
+    - setup: callable run before every run, not timed
+
+    Returns:
+    - seconds
+    """
+    best = np.inf
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def run_benchmarks(root, preset="small", repeat=3):
+    """Generate a synthetic data set if needed and time the hot paths on it
+
+    Args:
+    - root: directory of the synthetic data set
+    - preset: size of the data set, see synthetic.PRESETS
+    - repeat: number of runs per benchmark
+
+    Returns:
+    - A dict with keys being benchmark name and value being the best time in seconds
+    """
+    import geopandas as gpd
+    import draw_utils
+    from synthetic import make_dataset
+    from ingest import split_city_files, ingest_astra_files, ingest_canton_files
+    from utils import read_from_ids, query, query_by_sensor, relative, normalize, compute_yoy, SCALES
+    from geo_utils import join_sensor_values, assign_districts, aggregate_by_district
+
+    results = {}
+    raw = os.path.join(root, "raw_data")
+    if not os.path.isdir(raw):
+        make_dataset(root, preset)
+    preprocessed = os.path.join(root, "preprocessed_data")
+
+    def listdir(path):
+        return [os.path.join(path, name) for name in sorted(os.listdir(path))]
+
+    # Ingestion, run once as it writes its output
+    for name, ingest, source, out in [("ingest_city", split_city_files, "city", "city"),
+                                      ("ingest_canton", ingest_canton_files, "canton", "canton_vehicles"),
+                                      ("ingest_astra", ingest_astra_files, "astra", "astra_vehicles")]:
+        results[name] = timeit(lambda: ingest(listdir(os.path.join(raw, source)), os.path.join(preprocessed, out)), repeat=1)
+
+    # Loading
+    city_dir = os.path.join(preprocessed, "city")
+    city_gdf = gpd.read_file(os.path.join(root, "spatial", "loop_update_city.geojson"))
+    ids = list(city_gdf["detid"])
+    results["read_from_ids"] = timeit(lambda: read_from_ids(ids, "workday", city_dir), repeat)
+    data_dict = read_from_ids(ids, "workday", city_dir)
+    data_list = list(data_dict.values())
+
+    # Querying
+    begin = min(data["date"].min() for data in data_list)
+    end = max(data["date"].max() for data in data_list) + pd.Timedelta(days=1)
+    for scale in SCALES:
+        results["query_" + scale] = timeit(lambda: query(data_list, begin, end, scale), repeat)
+    results["query_all_scales"] = timeit(lambda: query(data_list, begin, end, list(SCALES)), repeat)
+    results["query_by_sensor_month"] = timeit(lambda: query_by_sensor(data_dict, begin, end, "month"), repeat)
+    window = pd.Timedelta(days=7)
+    results["query_rolling_week"] = timeit(lambda: [query(data_list, t, t + window, "hour") for t in pd.date_range(begin, end - window, freq="7D")], repeat)
+
+    # Helpers on a batch of profiles
+    profiles = query_by_sensor(data_dict, begin, end, "hour").to_numpy()
+    results["relative"] = timeit(lambda: relative(profiles, axis=-1), repeat)
+    results["normalize"] = timeit(lambda: normalize(profiles, axis=-1), repeat)
+    results["compute_yoy"] = timeit(lambda: compute_yoy(profiles, profiles[::-1]), repeat)
+
+    # Drawing, including the serialization of the figure
+    monthly = query_by_sensor(data_dict, begin, end, "month").fillna(0)
+    lat, lon, z = join_sensor_values(city_gdf, monthly)
+    district_gdf = gpd.read_file(os.path.join(root, "spatial", "districts.geojson"))
+    by_district = aggregate_by_district(assign_districts(city_gdf, district_gdf), monthly, district_gdf["id"]).fillna(0)
+    legends = [str(month) for month in monthly.columns]
+    hourly = query(data_list, begin, end, "hour")
+    x = [hourly["hour"].to_list()] * 2
+    y = [hourly["occ"].to_list(), hourly["flow"].to_list()]
+    builders = {
+        "draw_bar_plot": lambda: draw_utils.draw_bar_plot(["occ", "flow"], x, y),
+        "draw_bar_plot_with_slider": lambda: draw_utils.draw_bar_plot_with_slider(["occ", "flow"], x, y),
+        "draw_line_plot": lambda: draw_utils.draw_line_plot(["occ", "flow"], x, y),
+        "draw_bubble_map": lambda: draw_utils.draw_bubble_map("occ", lat, lon, z[:, 0]),
+        "draw_density_map": lambda: draw_utils.draw_density_map("occ", lat, lon, z[:, 0]),
+        "draw_density_map_with_slider": lambda: draw_utils.draw_density_map_with_slider(legends, [lat] * len(legends), [lon] * len(legends), list(z.T)),
+        "draw_choropleth_map": lambda: draw_utils.draw_choropleth_map("occ", district_gdf, by_district.iloc[:, 0]),
+        "draw_choropleth_with_slider": lambda: draw_utils.draw_choropleth_with_slider(legends, district_gdf, [by_district[c] for c in by_district.columns]),
+        "draw_scatter_3d": lambda: draw_utils.draw_scatter_3d(lat, lon, z[:, 0], z[:, 0]),
+    }
+    for name, builder in builders.items():
+        results[name] = timeit(lambda: builder().to_json(), repeat)
+    return results
+
+def save_results(results, path, preset):
+    """Append benchmark results to a JSON lines file, one line per benchmark"""
+    run = dict(commit=_commit(), time=datetime.now().isoformat(timespec="seconds"), preset=preset,
+               python=platform.python_version(), pandas=pd.__version__, numpy=np.__version__)
+    with open(path, "a") as f:
+        for name, seconds in results.items():
+            f.write(json.dumps(dict(run, name=name, seconds=seconds)) + "\n")
+
+def compare_runs(path, base, head, preset="small"):
+    """Compare the results of two commits
+
+    Args:
+    - path: JSON lines file written by save_results
+    - base, head: commits to compare, the latest run of each is used
+    - preset: size of the data set the runs used
+
+    Returns:
+    - pd.DataFrame indexed by benchmark name with the times of both commits (base, head) and their ratio
+    """
+    runs = pd.read_json(path, lines=True, dtype={"commit": str})
+    runs = runs[runs["preset"] == preset].drop_duplicates(["commit", "name"], keep="last")
+    seconds = runs.pivot(index="name", columns="commit", values="seconds")
+    table = pd.DataFrame({"base": seconds[base], "head": seconds[head]})
+    table["ratio"] = table["head"] / table["base"]
+    return table
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark loading, querying and drawing on synthetic data")
+    parser.add_argument("--preset", default="small", choices=["small", "medium", "large"])
+    parser.add_argument("--root", default="./synthetic_data", help="directory of the synthetic data set")
+    parser.add_argument("--out", default="benchmarks.jsonl", help="JSON lines file the results are appended to")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "HEAD"), help="compare two commits instead of running")
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        print(compare_runs(args.out, args.compare[0], args.compare[1], args.preset).to_string())
+        sys.exit()
+    results = run_benchmarks(os.path.join(args.root, args.preset), args.preset, args.repeat)
+    save_results(results, args.out, args.preset)
+    for name, seconds in results.items():
+        print(name.ljust(32), "%.4f" % seconds)
@@ -0,0 +1,274 @@
+import pandas as pd
+import numpy as np
+import os
+import shutil
+from tqdm import tqdm
+from utils import read_from_ids, _by_scale, _check_scales, _quality_mask
+from rollup import STATS, _buckets, _reduce
+from profiling import span, add_rows
+
+"""
+Out-of-core backend of query over a partitioned dataset on disk, for histories that do not fit
+in memory as one dataframe per sensor.
+
+The dataset is partitioned by source, daytype and year:
+
+    root/<source>/<daytype>/<year>/part-00000/
+
+and every part holds one .npy file per column (date, hour, occ, flow, complete and the quality
+flags valid, suspect), with the rows sorted by sensor and then by date, plus:
+- sensors.npy: sensor ids of the part, sorted
+- offsets.npy: rows of sensor i are offsets[i]:offsets[i+1]
+
+A query prunes partitions by source, daytype and year, then memory-maps the columns of the
+remaining parts and only reads the rows of the requested sensors in [begin, end), found by binary
+search on their dates, skipping the rows failing a quality policy. The rows are reduced chunk by chunk into the (date, hour) buckets of
+rollup.py, so memory does not grow with the number of rows scanned.
+"""
+
+COLUMNS = ["date", "hour", "occ", "flow", "complete"]
+# Quality flags of the city data and the value they get for sensors without them
+FLAGS = {"valid": 1, "suspect": 0}
+
+def _write_part(columns, sensors, offsets, year_dir):
+    """Write a part into a new directory of year_dir, through a temporary directory such that
+    readers never see half a part
+    """
+    os.makedirs(year_dir, exist_ok=True)
+    n = len([name for name in os.listdir(year_dir) if name.startswith("part-") and not name.endswith(".tmp")])
+    path = os.path.join(year_dir, "part-%05d" % n)
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for name, values in columns.items():
+        np.save(os.path.join(tmp_path, name + ".npy"), values)
+    np.save(os.path.join(tmp_path, "sensors.npy"), np.array(sensors, dtype=str))
+    np.save(os.path.join(tmp_path, "offsets.npy"), np.array(offsets, dtype=np.int64))
+    os.replace(tmp_path, path)
+    return path
+
+def write_partitions(data_dict, root, source, daytype):
+    """Append sensor data to a partitioned dataset, as one new part per year. Sensors must not
+    already be in the dataset for these years, their rows would be counted twice.
+
+    Args:
+    - data_dict: dict with keys being sensor id and value being sensor dataframe, as returned by read_from_ids
+    - root: root directory of the dataset
+    - source: name of the data source, e.g. "city", "canton" or "astra"
+    - daytype: {"workday", "weekend", "holiday"}, the daytype of the data
+
+    Returns:
+    - A dict with keys being year and value being the number of rows written
+    """
+    per_year = {}
+    for id in sorted(data_dict):
+        data = data_dict[id]
+        # Missing values in any column, as in utils.query
+        complete = data.notna().all(axis=1).to_numpy()
+        date = data["date"].to_numpy().astype("datetime64[ns]")
+        order = np.argsort(date, kind="stable")
+        date = date[order]
+        columns = {"date": date, "hour": data["hour"].to_numpy()[order], "occ": data["occ"].to_numpy(dtype=np.float64)[order],
+                   "flow": data["flow"].to_numpy(dtype=np.float64)[order], "complete": complete[order]}
+        for flag, default in FLAGS.items():
+            values = data[flag].to_numpy() if flag in data.columns else np.full(len(data), default)
+            columns[flag] = values.astype(np.int8)[order]
+        years = date.astype("datetime64[Y]").astype(np.int64) + 1970
+        bounds = np.flatnonzero(np.diff(years)) + 1
+        for lo, hi in zip(np.r_[0, bounds], np.r_[bounds, len(date)]):
+            per_year.setdefault(int(years[lo]), []).append((id, {name: values[lo:hi] for name, values in columns.items()}))
+
+    rows = {}
+    for year, sensor_columns in per_year.items():
+        lengths = [len(columns["date"]) for _, columns in sensor_columns]
+        columns = {name: np.concatenate([columns[name] for _, columns in sensor_columns]) for name in COLUMNS + list(FLAGS)}
+        _write_part(columns, [id for id, _ in sensor_columns], np.r_[0, np.cumsum(lengths)],
+                    os.path.join(root, source, daytype, str(year)))
+        rows[year] = int(sum(lengths))
+    return rows
+
+def build_dataset(ids, daytype, dir, root, source, batch_size=64, n_workers=None):
+    """Build the partitions of a source and daytype from per-sensor files, reading a batch of
+    sensors at a time. Existing partitions of this source and daytype are replaced.
+
+    Args:
+    - ids: list of sensor ids
+    - daytype: {"workday", "weekend", "holiday"}
+    - dir: directory containing files, as for read_from_ids
+    - root: root directory of the dataset
+    - source: name of the data source, e.g. "city", "canton" or "astra"
+    - batch_size: number of sensors held in memory at once
+    - n_workers: number of threads reading a batch, if None, use the default of ThreadPoolExecutor, min(32, number of cpus + 4)
+
+    Returns:
+    - PartitionedDataset opened on root
+    """
+    shutil.rmtree(os.path.join(root, source, daytype), ignore_errors=True)
+    for i in tqdm(range(0, len(ids), batch_size), desc="Partitioning " + daytype + " data"):
+        data_dict = read_from_ids(ids[i:i + batch_size], daytype, dir, n_workers)
+        write_partitions(data_dict, root, source, daytype)
+    return open_dataset(root)
+
+class PartitionedDataset:
+    """A partitioned dataset on disk opened by open_dataset, see the module documentation.
+    It can be passed to utils.query in place of the list of sensor dataframes.
+    """
+    def __init__(self, root, chunk_rows=4000000):
+        self.root = root
+        self.chunk_rows = chunk_rows
+
+    def sources(self):
+        """Data sources in the dataset"""
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(name for name in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, name)))
+
+    def daytypes(self, source=None):
+        """Daytypes in the dataset, of a source if given"""
+        return sorted(set(name for s in (self.sources() if source is None else [source])
+                          if os.path.isdir(os.path.join(self.root, s))
+                          for name in os.listdir(os.path.join(self.root, s))
+                          if os.path.isdir(os.path.join(self.root, s, name))))
+
+    def parts(self, begin=None, end=None, source=None, daytype=None):
+        """Part directories that may hold rows in [begin, end), pruned by source, daytype and year
+
+        Args:
+        - begin, end: datetime, if None, unbounded
+        - source: data source, if None, all sources
+        - daytype: daytype, if None, all daytypes
+
+        Returns:
+        - list of paths
+        """
+        paths = []
+        for s in (self.sources() if source is None else [source]):
+            source_dir = os.path.join(self.root, s)
+            if not os.path.isdir(source_dir):
+                continue
+            daytypes = sorted(os.listdir(source_dir)) if daytype is None else [daytype]
+            for d in daytypes:
+                daytype_dir = os.path.join(source_dir, d)
+                if not os.path.isdir(daytype_dir):
+                    continue
+                for year in sorted(os.listdir(daytype_dir)):
+                    if begin is not None and pd.Timestamp(int(year) + 1, 1, 1) <= begin:
+                        continue
+                    if end is not None and pd.Timestamp(int(year), 1, 1) >= end:
+                        continue
+                    year_dir = os.path.join(daytype_dir, year)
+                    paths += [os.path.join(year_dir, name) for name in sorted(os.listdir(year_dir))
+                              if name.startswith("part-") and not name.endswith(".tmp")]
+        return paths
+
+    def _ranges(self, part, begin, end, ids):
+        """Row ranges of a part for the sensors ids in [begin, end), by binary search on the dates"""
+        sensors = np.load(os.path.join(part, "sensors.npy"))
+        offsets = np.load(os.path.join(part, "offsets.npy"))
+        dates = np.load(os.path.join(part, "date.npy"), mmap_mode="r")
+        selected = range(len(sensors)) if ids is None else np.flatnonzero(np.isin(sensors, ids))
+        begin, end = np.datetime64(pd.Timestamp(begin), "ns"), np.datetime64(pd.Timestamp(end), "ns")
+        ranges = []
+        for i in selected:
+            lo, hi = offsets[i], offsets[i + 1]
+            sensor_dates = dates[lo:hi]
+            a = lo + np.searchsorted(sensor_dates, begin, side="left")
+            b = lo + np.searchsorted(sensor_dates, end, side="left")
+            if b > a:
+                ranges.append((a, b))
+        return ranges
+
+    def scan(self, begin, end, ids=None, source=None, daytype=None, quality=None):
+        """Stream the rows in [begin, end) of the selected sensors, only reading these rows from disk
+
+        Args:
+        - begin, end: datetime
+        - ids: list of sensor ids, if None, all sensors
+        - source: data source, if None, all sources
+        - daytype: daytype, if None, all daytypes
+        - quality: quality policy on the valid/suspect flags (see utils.read_from_ids), failing
+          rows are skipped. Parts written without flags pass every policy
+
+        Yields:
+        - A dict with keys being column name and value being numpy array, holding at most about chunk_rows rows
+        """
+        for part in self.parts(begin, end, source, daytype):
+            ranges = self._ranges(part, begin, end, ids)
+            if len(ranges) == 0:
+                continue
+            names = COLUMNS + [flag for flag in FLAGS if quality is not None and os.path.exists(os.path.join(part, flag + ".npy"))]
+            columns = {name: np.load(os.path.join(part, name + ".npy"), mmap_mode="r") for name in names}
+            chunk = []
+            n = 0
+            for i, (a, b) in enumerate(ranges):
+                chunk.append((a, b))
+                n += b - a
+                if n >= self.chunk_rows or i == len(ranges) - 1:
+                    rows = {name: np.concatenate([values[a:b] for a, b in chunk]) for name, values in columns.items()}
+                    mask = _quality_mask(rows, quality)
+                    yield rows if mask is None else {name: values[mask] for name, values in rows.items()}
+                    chunk = []
+                    n = 0
+
+    def buckets(self, begin, end, ids=None, source=None, daytype=None, quality=None):
+        """Partial aggregates of the rows in [begin, end) per (date, hour) bucket, see rollup.py
+
+        Returns:
+        - pd.DataFrame with columns date, hour and rollup.STATS
+        """
+        chunks = []
+        for chunk in self.scan(begin, end, ids, source, daytype, quality):
+            with span("reduce_chunk"):
+                chunks.append(_buckets(chunk["date"], chunk["hour"], chunk["occ"], chunk["flow"], chunk["complete"]))
+                add_rows(len(chunk["date"]))
+        if len(chunks) == 0:
+            columns = {"date": np.array([], dtype="datetime64[ns]"), "hour": np.array([], dtype=np.int64)}
+            columns.update({name: np.array([], dtype=np.float64) for name in STATS})
+            return pd.DataFrame(columns)
+        return pd.concat(chunks, ignore_index=True).groupby(["date", "hour"], sort=True).sum().reset_index()
+
+    def query(self, begin, end, scale, ids=None, source=None, daytype=None, with_std=False, quality=None):
+        """Query the aggregated data in (begin, end) for a scale, gives the same statistics as
+        utils.query on the sensor dataframes
+
+        Args:
+        - begin, end: datetime
+        - scale: {hour, day, week, month}, or a list of them
+        - ids: list of sensor ids to consider, if None, use all sensors
+        - source: data source to consider, if None, use all sources
+        - daytype: daytype to consider, if None, use all daytypes
+        - with_std: whether to also return the standard deviations "occ_std" and "flow_std"
+        - quality: quality policy on the valid/suspect flags, see scan
+
+        Returns:
+        - Statistics(a pd.DataFrame) on these sensors during a specific time range. If a list of
+          scales is given, a dict with keys being scale and value being corresponding statistics
+        """
+        _check_scales(scale)
+        with span("dataset_scan"):
+            buckets = self.buckets(begin, end, ids, source, daytype, quality)
+        return _by_scale(scale, lambda s: _reduce(buckets, s, with_std))
+
+def open_dataset(root, chunk_rows=4000000):
+    """Open a partitioned dataset
+
+    Args:
+    - root: root directory of the dataset
+    - chunk_rows: number of rows reduced at once by queries
+
+    Returns:
+    - PartitionedDataset
+    """
+    return PartitionedDataset(root, chunk_rows)
+
+# Testing
+if __name__ == "__main__":
+    from datetime import datetime
+    id_path = "./preprocessed_data/city/city_id.csv"
+    data_path = "./preprocessed_data/city"
+    dataset_path = "./preprocessed_data/dataset"
+    id = list(pd.read_csv(id_path)["detid"])
+    for daytype in ["workday", "weekend", "holiday"]:
+        build_dataset(id, daytype, data_path, dataset_path, "city")
+    dataset = open_dataset(dataset_path)
+    print(dataset.query(datetime(2018,1,1), datetime(2019,1,1), "month", source="city", daytype="weekend"))
@@ -1,15 +1,58 @@
+import plotly
 import plotly.graph_objects as go
-import plotly.express as px
+import plotly.colors
 import pandas as pd
 import random
 from utils import *
-import geopandas as gpd
-import json
+from geo_utils import join_sensor_values, to_geojson, bin_points
+from profiling import span, add_rows
 
 """
 Utilities for simplifying drawing, using plotly
 """
 
+# plotly >= 6 serializes numpy arrays as base64 typed arrays instead of JSON lists
+TYPED_ARRAYS = int(plotly.__version__.split(".")[0]) >= 6
+
+def _typed_array(values):
+    """Values of a frame as a numpy array, float32 when plotly encodes them as typed arrays"""
+    values = np.asarray(values)
+    if TYPED_ARRAYS and values.dtype.kind == "f":
+        values = values.astype(np.float32)
+    return values
+
+def _bin_points_for_map(lat, lon, z, max_points, mapbox_dict, bin_dict, agg="mean"):
+    """Bin the points of a map with geo_utils.bin_points if there are more than max_points of them,
+    with bin_dict["agg"] or else agg as the reduction per cell
+
+    Returns:
+    - lat, lon, z and the number of points per cell, or None if the points are drawn as they are
+    """
+    if max_points is None or len(lat) <= max_points:
+        return None
+    zoom = bin_dict.get("zoom", mapbox_dict.get("zoom", 12))
+    with span("bin_points"):
+        bin_lat, bin_lon, bin_z, count, _ = bin_points(lat, lon, z, zoom, bin_dict.get("cell_px", 20),
+                                                       bin_dict.get("kind", "square"), bin_dict.get("agg", agg))
+        add_rows(len(lat))
+    return bin_lat, bin_lon, bin_z, count
+
+def _frame_steps(fig, legends, frame_traces):
+    """Add one animation frame per slider step to a figure, each frame only carrying the data of
+    the first trace that changes, and return the slider steps jumping to them
+    """
+    fig.frames = [go.Frame(name=str(i), data=[trace], traces=[0]) for i, trace in enumerate(frame_traces)]
+    steps = []
+    for i, legend in enumerate(legends):
+        step = dict(
+            method="animate",
+            args=[[str(i)], dict(mode="immediate", frame=dict(duration=0, redraw=True), transition=dict(duration=0))],
+            label=legend
+        )
+        steps.append(step)
+    return steps
+
+@span("draw_bar_plot")
 def draw_bar_plot(legends, x, y, layout_dict=dict(), trace_dict=dict(), icolor=None):
     """Draw a bar plot. You can pass multiple x's and y's such that they appear on the same graph. If 
     you want to draw for single x and y, remember also to use []brackets to embrace them.
@@ -26,7 +69,7 @@ def draw_bar_plot(legends, x, y, layout_dict=dict(), trace_dict=dict(), icolor=N
     - Plotly figure
     """
     # Draw figure with random color
-    colors = px.colors.qualitative.T10.copy() + px.colors.qualitative.G10.copy() + px.colors.qualitative.D3.copy() + px.colors.qualitative.Bold.copy()
+    colors = plotly.colors.qualitative.T10.copy() + plotly.colors.qualitative.G10.copy() + plotly.colors.qualitative.D3.copy() + plotly.colors.qualitative.Bold.copy()
     fig = go.Figure()
     for i in range(len(legends)):
         if icolor == None:
@@ -64,7 +107,8 @@ def draw_bar_plot(legends, x, y, layout_dict=dict(), trace_dict=dict(), icolor=N
 
     return fig
 
-def draw_bar_plot_with_slider(legends, x, y, layout_dict=dict(), trace_dict=dict(), icolor=None):
+@span("draw_bar_plot_with_slider")
+def draw_bar_plot_with_slider(legends, x, y, layout_dict=dict(), trace_dict=dict(), icolor=None, use_frames=False):
     """Draw a bar plot with slider that changes the data to show
 
     Args:
@@ -74,20 +118,26 @@ def draw_bar_plot_with_slider(legends, x, y, layout_dict=dict(), trace_dict=dict
     - layout_dict: dictionary for updating default layout
     - trace_dict: dictionary for updating defauce trace config
     - icolor: list of integers. color index, if None, use default color scheme
+    - use_frames: if True, draw a single trace and one animation frame per step carrying only the
+      changed values, instead of one trace per step. Much smaller for many steps
 
     Returns:
     - Plotly figure
     """
     # Draw figure with random color
-    colors = px.colors.qualitative.T10.copy() + px.colors.qualitative.G10.copy() + px.colors.qualitative.D3.copy() + px.colors.qualitative.Bold.copy()
+    colors = plotly.colors.qualitative.T10.copy() + plotly.colors.qualitative.G10.copy() + plotly.colors.qualitative.D3.copy() + plotly.colors.qualitative.Bold.copy()
     
     fig = go.Figure()
+    marker_colors = []
     for i in range(len(legends)):
         if icolor == None:
             marker_color = colors[i]
             colors.remove(marker_color)
         else:
             marker_color = colors[icolor[i]]
+        marker_colors.append(marker_color)
+        if use_frames and i > 0:
+            continue
         fig.add_trace(
             go.Bar(
                 name = legends[i],
@@ -98,18 +148,28 @@ def draw_bar_plot_with_slider(legends, x, y, layout_dict=dict(), trace_dict=dict
         )
 
     # Set sliders
-    steps = []
-    for i, legend in enumerate(legends):
-        step = dict(
-            method="update",
-            args=[{"visible": [False] * len(legends)}],
-            label=legend
-        )
-        step["args"][0]["visible"][i] = True  
-        steps.append(step)
+    if use_frames:
+        frame_traces = []
+        for i in range(len(legends)):
+            frame_trace = go.Bar(name = legends[i], y = _typed_array(y[i]), marker_color = marker_colors[i])
+            if list(x[i]) != list(x[0]):
+                frame_trace.x = x[i]
+            frame_traces.append(frame_trace)
+        steps = _frame_steps(fig, legends, frame_traces)
+    else:
+        steps = []
+        for i, legend in enumerate(legends):
+            step = dict(
+                method="update",
+                args=[{"visible": [False] * len(legends)}],
+                label=legend
+            )
+            step["args"][0]["visible"][i] = True  
+            steps.append(step)
 
     sliders = [dict(
-        active=1,
+        # With frames only the first step is drawn until the slider moves
+        active=0 if use_frames else 1,
         steps=steps
     )]
 
@@ -136,6 +196,7 @@ def draw_bar_plot_with_slider(legends, x, y, layout_dict=dict(), trace_dict=dict
     return fig
 
 
+@span("draw_line_plot")
 def draw_line_plot(legends, x, y, layout_dict=dict(), trace_dict=dict(), icolor=None):
     """Draw a line plot. You can pass multiple x's and y's such that they appear on the same graph. If 
     you want to draw for single x and y, remember also to use []brackets to embrace them.
@@ -152,7 +213,7 @@ def draw_line_plot(legends, x, y, layout_dict=dict(), trace_dict=dict(), icolor=
     - Plotly figure
     """
     # Draw figure with random color
-    colors = px.colors.qualitative.T10.copy() + px.colors.qualitative.G10.copy() + px.colors.qualitative.D3.copy() + px.colors.qualitative.Bold.copy()
+    colors = plotly.colors.qualitative.T10.copy() + plotly.colors.qualitative.G10.copy() + plotly.colors.qualitative.D3.copy() + plotly.colors.qualitative.Bold.copy()
     fig = go.Figure()
     for i in range(len(legends)):
         if icolor == None:
@@ -190,7 +251,8 @@ def draw_line_plot(legends, x, y, layout_dict=dict(), trace_dict=dict(), icolor=
 
     return fig
 
-def draw_bubble_map(legend, lat, lon, z, layout_dict=dict(), mapbox_dict=dict(), trace_dict=dict()):
+@span("draw_bubble_map")
+def draw_bubble_map(legend, lat, lon, z, layout_dict=dict(), mapbox_dict=dict(), trace_dict=dict(), max_points=None, bin_dict=dict()):
     """Draw a density map
     
     Args:
@@ -200,24 +262,47 @@ def draw_bubble_map(legend, lat, lon, z, layout_dict=dict(), mapbox_dict=dict(),
     - z: list, value of each point
     - layout_dict: dictionary for updating default layout
     - trace_dict: dictionary for updating defauce trace config
+    - max_points: if there are more points than this, they are aggregated into a grid before
+      drawing instead of sending every point to the browser. If None, never aggregate
+    - bin_dict: options of the aggregation: "kind" ("square" or "hex"), "cell_px" (cell width in
+      pixels), "agg" ("mean", "sum" or "count", defaults to "mean") and "zoom" (zoom the cells
+      are sized for, defaults to the map zoom)
 
     Returns:
     - Plotly figure
     """
     fig = go.Figure()
-    fig.add_trace(
-        go.Scattermapbox(
-            name = legend,
-            lat = lat,
-            lon = lon,
-            marker = dict(
-                size = 13,
-                color = z,
-                showscale = True,
-                colorscale = "Portland"
-            ),
+    binned = _bin_points_for_map(lat, lon, z, max_points, mapbox_dict, bin_dict)
+    if binned is not None:
+        bin_lat, bin_lon, bin_z, count = binned
+        fig.add_trace(
+            go.Scattermapbox(
+                name = legend,
+                lat = bin_lat,
+                lon = bin_lon,
+                text = ["n=" + str(n) for n in count],
+                marker = dict(
+                    size = 13,
+                    color = bin_z,
+                    showscale = True,
+                    colorscale = "Portland"
+                ),
+            )
+        )
+    else:
+        fig.add_trace(
+            go.Scattermapbox(
+                name = legend,
+                lat = lat,
+                lon = lon,
+                marker = dict(
+                    size = 13,
+                    color = z,
+                    showscale = True,
+                    colorscale = "Portland"
+                ),
+            )
         )
-    )
 
     # Basic config
     fig.update_layout(
@@ -246,7 +331,8 @@ def draw_bubble_map(legend, lat, lon, z, layout_dict=dict(), mapbox_dict=dict(),
 
     return fig
 
-def draw_density_map(legend, lat, lon, z, layout_dict=dict(), mapbox_dict=dict(), trace_dict=dict()):
+@span("draw_density_map")
+def draw_density_map(legend, lat, lon, z, layout_dict=dict(), mapbox_dict=dict(), trace_dict=dict(), max_points=None, bin_dict=dict()):
     """Draw a density map
     
     Args:
@@ -256,22 +342,42 @@ def draw_density_map(legend, lat, lon, z, layout_dict=dict(), mapbox_dict=dict()
     - z: list, value of each point
     - layout_dict: dictionary for updating default layout
     - trace_dict: dictionary for updating defauce trace config
+    - max_points: if there are more points than this, they are aggregated into a grid before
+      drawing instead of sending every point to the browser. If None, never aggregate
+    - bin_dict: options of the aggregation: "kind" ("square" or "hex"), "cell_px" (cell width in
+      pixels), "agg" ("mean", "sum" or "count", defaults to "sum" such that cells keep the total
+      weight of their points) and "zoom" (zoom the cells are sized for, defaults to the map zoom)
 
     Returns:
     - Plotly figure
     """
     fig = go.Figure()
-    fig.add_trace(
-        go.Densitymapbox(
-            name = legend,
-            lat = lat,
-            lon = lon,
-            z = z,
-            radius = 10,
-            opacity = 0.9,
-            colorscale= "Portland"
+    binned = _bin_points_for_map(lat, lon, z, max_points, mapbox_dict, bin_dict, agg="sum")
+    if binned is not None:
+        bin_lat, bin_lon, bin_z, count = binned
+        fig.add_trace(
+            go.Densitymapbox(
+                name = legend,
+                lat = bin_lat,
+                lon = bin_lon,
+                z = bin_z,
+                radius = 10,
+                opacity = 0.9,
+                colorscale= "Portland"
+            )
+        )
+    else:
+        fig.add_trace(
+            go.Densitymapbox(
+                name = legend,
+                lat = lat,
+                lon = lon,
+                z = z,
+                radius = 10,
+                opacity = 0.9,
+                colorscale= "Portland"
+            )
         )
-    )
 
     # Basic config
     fig.update_layout(
@@ -300,7 +406,8 @@ def draw_density_map(legend, lat, lon, z, layout_dict=dict(), mapbox_dict=dict()
 
     return fig
 
-def draw_density_map_with_slider(legends, lat, lon, z, layout_dict=dict(), mapbox_dict=dict(), trace_dict=dict()):
+@span("draw_density_map_with_slider")
+def draw_density_map_with_slider(legends, lat, lon, z, layout_dict=dict(), mapbox_dict=dict(), trace_dict=dict(), use_frames=False):
     """Draw a scatter geo map with a slide that changes the data to show
     
     Args:
@@ -310,12 +417,16 @@ def draw_density_map_with_slider(legends, lat, lon, z, layout_dict=dict(), mapbo
     - z: list of list, value of each point
     - layout_dict: dictionary for updating default layout
     - trace_dict: dictionary for updating defauce trace config
+    - use_frames: if True, draw a single trace and one animation frame per step carrying only the
+      changed values, instead of one trace per step. Much smaller for many steps
 
     Returns:
     - Plotly figure
     """
     fig = go.Figure()
     for i in range(len(legends)):
+        if use_frames and i > 0:
+            continue
         fig.add_trace(
             go.Densitymapbox(
                 name = legends[i],
@@ -329,18 +440,29 @@ def draw_density_map_with_slider(legends, lat, lon, z, layout_dict=dict(), mapbo
         )
 
     # Set sliders
-    steps = []
-    for i, legend in enumerate(legends):
-        step = dict(
-            method="update",
-            args=[{"visible": [False] * len(legends)}],
-            label=legend
-        )
-        step["args"][0]["visible"][i] = True  
-        steps.append(step)
+    if use_frames:
+        frame_traces = []
+        for i in range(len(legends)):
+            frame_trace = go.Densitymapbox(name = legends[i], z = _typed_array(z[i]))
+            if not (np.array_equal(lat[i], lat[0]) and np.array_equal(lon[i], lon[0])):
+                frame_trace.lat = _typed_array(lat[i])
+                frame_trace.lon = _typed_array(lon[i])
+            frame_traces.append(frame_trace)
+        steps = _frame_steps(fig, legends, frame_traces)
+    else:
+        steps = []
+        for i, legend in enumerate(legends):
+            step = dict(
+                method="update",
+                args=[{"visible": [False] * len(legends)}],
+                label=legend
+            )
+            step["args"][0]["visible"][i] = True  
+            steps.append(step)
 
     sliders = [dict(
-        active=1,
+        # With frames only the first step is drawn until the slider moves
+        active=0 if use_frames else 1,
         steps=steps
     )]
 
@@ -372,7 +494,8 @@ def draw_density_map_with_slider(legends, lat, lon, z, layout_dict=dict(), mapbo
 
     return fig
 
-def draw_choropleth_map(legend, gdf, z, layout_dict=dict(), mapbox_dict=dict(), trace_dict=dict()):
+@span("draw_choropleth_map")
+def draw_choropleth_map(legend, gdf, z, layout_dict=dict(), mapbox_dict=dict(), trace_dict=dict(), simplify=None, grid_size=None):
     """Draw a choropleth map
     Note that the geo dataframe must contain a coloum named "id"
 
@@ -383,12 +506,14 @@ def draw_choropleth_map(legend, gdf, z, layout_dict=dict(), mapbox_dict=dict(),
     - layout_dict: dictionary for updating default layout
     - mapbox_dict: dictionary for updating default mapbox config
     - trace_dict: dictionary for updating defauce trace config
+    - simplify: tolerance for simplifying the polygons, see geo_utils.to_geojson
+    - grid_size: precision of the coordinates, see geo_utils.to_geojson
 
     Returns:
     - Plotly figure
     """
     fig = go.Figure()
-    geojson = json.loads(gdf.to_json())
+    geojson = to_geojson(gdf, "id", simplify, grid_size)
     fig.add_trace(
         go.Choroplethmapbox(
             name=legend,
@@ -419,9 +544,11 @@ def draw_choropleth_map(legend, gdf, z, layout_dict=dict(), mapbox_dict=dict(),
 
     return fig
 
-def draw_choropleth_with_slider(legends, gdf, z, layout_dict=dict(), mapbox_dict=dict(), trace_dict=dict()):
+@span("draw_choropleth_with_slider")
+def draw_choropleth_with_slider(legends, gdf, z, layout_dict=dict(), mapbox_dict=dict(), trace_dict=dict(), simplify=None, grid_size=None, use_frames=False):
     """Draw a choropleth map with a slider that changes the data to show
     Note that the geo dataframe must contain a coloum named "id"
+    The polygons are embedded once in a single trace, the slider only changes its values.
     
     Args:
     - legends: list of string, legend
@@ -430,40 +557,46 @@ def draw_choropleth_with_slider(legends, gdf, z, layout_dict=dict(), mapbox_dict
     - layout_dict: dictionary for updating default layout
     - mapbox_dict: dictionary for updating default mapbox config
     - trace_dict: dictionary for updating defauce trace config
+    - simplify: tolerance for simplifying the polygons, see geo_utils.to_geojson
+    - grid_size: precision of the coordinates, see geo_utils.to_geojson
+    - use_frames: if True, the slider jumps between animation frames carrying the values instead
+      of restyling the trace
 
     Returns:
     - Plotly figure
     """
     fig = go.Figure()
-    geojson = json.loads(gdf.to_json())
+    geojson = to_geojson(gdf, "id", simplify, grid_size)
 
-    for i in range(len(legends)):
-        fig.add_trace(
-            go.Choroplethmapbox(
-                name=legends[i],
-                featureidkey="properties.id",
-                geojson=geojson,
-                locations=gdf['id'].astype(str),
-                z=z[i],
-                marker_opacity=0.5, 
-                marker_line_width=0.3,
-                colorscale="Portland"
-            )
+    fig.add_trace(
+        go.Choroplethmapbox(
+            name=legends[0],
+            featureidkey="properties.id",
+            geojson=geojson,
+            locations=gdf['id'].astype(str),
+            z=z[0],
+            marker_opacity=0.5, 
+            marker_line_width=0.3,
+            colorscale="Portland"
         )
+    )
 
     # Set sliders
-    steps = []
-    for i, legend in enumerate(legends):
-        step = dict(
-            method="update",
-            args=[{"visible": [False] * len(legends)}],
-            label=legend
-        )
-        step["args"][0]["visible"][i] = True  
-        steps.append(step)
+    if use_frames:
+        frame_traces = [go.Choroplethmapbox(name=legends[i], z=_typed_array(z[i])) for i in range(len(legends))]
+        steps = _frame_steps(fig, legends, frame_traces)
+    else:
+        steps = []
+        for i, legend in enumerate(legends):
+            step = dict(
+                method="restyle",
+                args=[{"z": [z[i]], "name": [legend]}],
+                label=legend
+            )
+            steps.append(step)
 
     sliders = [dict(
-        active=1,
+        active=0,
         steps=steps
     )]
 
@@ -495,7 +628,10 @@ def draw_choropleth_with_slider(legends, gdf, z, layout_dict=dict(), mapbox_dict
 
     return fig
 
+@span("draw_scatter_3d")
 def draw_scatter_3d(x, y, z, color, layout_dict=dict(), trace_dict=dict()):
+    # plotly.express is slow to import and only needed here
+    import plotly.express as px
     fig = px.scatter_3d(x=x, y=y, z=z, color=color)
 
     fig.update_layout(
@@ -531,6 +667,7 @@ if __name__ == "__main__":
     """
     Test code below
     """
+    import geopandas as gpd
     id_path = "./preprocessed_data/city/city_id.csv"
     data_path = "./preprocessed_data/city"
     id = list(pd.read_csv(id_path)["detid"])
@@ -555,20 +692,9 @@ if __name__ == "__main__":
     geo_district_path =  "./spatial/districts/"
 
     city_gdf = gpd.read_file(geo_sensor_path).to_crs("EPSG:4326")
-    city_geo_list = np.array([[point.xy[1][0], point.xy[0][0]] for point in city_gdf['geometry']])
-
-    city_gdf_indexed = city_gdf.set_index("detid")
-    lat = []
-    lon = []
-    sensor_data_list = []
-    for detid in tqdm(city_gdf["detid"], desc="Collecting data for every sensor"):
-        if detid in list(weekend_df_dict.keys()):
-            sensor_data_list.append(query([weekend_df_dict[detid]], datetime(2018,1,1), datetime(2018,2,1), "month")["occ"])
-            lat.append(city_gdf_indexed.loc[detid]["geometry"].xy[1][0])
-            lon.append(city_gdf_indexed.loc[detid]["geometry"].xy[0][0])
-    
-    sensor_data_df = pd.concat(sensor_data_list, axis = 1).fillna(0)
-    z = sensor_data_df.to_numpy()[0] * 10
+
+    sensor_data_df = query_by_sensor(weekend_df_dict, datetime(2018,1,1), datetime(2018,2,1), "month", "occ")
+    lat, lon, z = join_sensor_values(city_gdf, sensor_data_df[1].fillna(0) * 10)
     fig = draw_density_map("test", lat, lon, z)
     fig.write_html("test3.html")
 
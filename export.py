@@ -0,0 +1,116 @@
+import os
+import json
+import pickle
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm import tqdm
+from profiling import span
+
+"""
+Batch export of figures drawn with the draw_* builders of draw_utils
+"""
+
+MANIFEST = ".export_manifest.json"
+
+def spec_hash(spec, image_format=None):
+    """Content hash of a figure spec, changes whenever the builder, its inputs or the plotly version change"""
+    import plotly
+    h = hashlib.sha1()
+    h.update(pickle.dumps((spec["builder"], spec.get("args", []), spec.get("kwargs", {}), image_format, plotly.__version__),
+                          protocol=4))
+    return h.hexdigest()
+
+def _bundle_name():
+    """File name of the plotly.js bundle shared by the exported html, versioned such that html
+    written by another plotly version keeps the bundle it was written for
+    """
+    import plotly
+    return "plotly-" + plotly.__version__ + ".min.js"
+
+def _render(spec, out_dir, image_format):
+    """Draw a figure and write it, run in the worker processes of export_figures"""
+    import draw_utils
+    builder = getattr(draw_utils, spec["builder"])
+    fig = builder(*spec.get("args", []), **spec.get("kwargs", {}))
+    paths = [os.path.join(out_dir, spec["name"] + ".html")]
+    # The html references the shared bundle written next to it by export_figures
+    with span("write_html"):
+        fig.write_html(paths[0] + ".tmp", include_plotlyjs=_bundle_name())
+        os.replace(paths[0] + ".tmp", paths[0])
+    if image_format is not None:
+        paths.append(os.path.join(out_dir, spec["name"] + "." + image_format))
+        with span("write_image"):
+            fig.write_image(paths[-1], format=image_format)
+    return paths
+
+def export_figures(specs, out_dir, n_workers=None, image_format=None, force=False):
+    """Draw and write a batch of figures in parallel. All html files share a single
+    plotly-<version>.min.js in out_dir instead of embedding 3.5MB of javascript each. Figures whose spec has not changed
+    since the last export are skipped.
+
+    Args:
+    - specs: list of dict with keys "name" (output file name without extension), "builder" (name of
+      a draw_* function of draw_utils), "args" (list) and "kwargs" (dict). Arguments must be picklable
+    - out_dir: output directory
+    - n_workers: number of processes, if None, use the number of cpus
+    - image_format: if given, also write a static image, e.g. "png" or "svg" (requires kaleido)
+    - force: whether to draw every figure, even unchanged ones
+
+    Returns:
+    - A dict with keys being figure name and value being "written", "skipped" or the reason of failure
+    """
+    if image_format is not None:
+        try:
+            import kaleido
+        except ImportError:
+            raise ImportError("Writing static images requires kaleido, install it with pip install kaleido")
+    from plotly.offline import get_plotlyjs
+
+    os.makedirs(out_dir, exist_ok=True)
+    bundle_path = os.path.join(out_dir, _bundle_name())
+    if not os.path.exists(bundle_path):
+        with open(bundle_path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(get_plotlyjs())
+        os.replace(bundle_path + ".tmp", bundle_path)
+
+    manifest_path = os.path.join(out_dir, MANIFEST)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    status = {}
+    todo = []
+    for spec in specs:
+        h = spec_hash(spec, image_format)
+        html_path = os.path.join(out_dir, spec["name"] + ".html")
+        if not force and manifest.get(spec["name"]) == h and os.path.exists(html_path):
+            status[spec["name"]] = "skipped"
+        else:
+            todo.append((spec, h))
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {executor.submit(_render, spec, out_dir, image_format): (spec, h) for spec, h in todo}
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Exporting figures"):
+            spec, h = futures[future]
+            try:
+                future.result()
+                manifest[spec["name"]] = h
+                status[spec["name"]] = "written"
+            except Exception as e:
+                manifest.pop(spec["name"], None)
+                status[spec["name"]] = type(e).__name__ + ": " + str(e)
+            # Keep the manifest up to date such that an interrupted export can be resumed
+            with open(manifest_path + ".tmp", "w") as f:
+                json.dump(manifest, f, indent=1)
+            os.replace(manifest_path + ".tmp", manifest_path)
+    return status
+
+# Testing
+if __name__ == "__main__":
+    specs = [
+        dict(name="line", builder="draw_line_plot", args=[["a", "b"], [[1, 2, 3], [1, 2, 3]], [[1, 4, 9], [1, 2, 3]]]),
+        dict(name="bar", builder="draw_bar_plot", args=[["a"], [[1, 2, 3]], [[3, 1, 2]]], kwargs=dict(layout_dict=dict(title="Test"))),
+    ]
+    print(export_figures(specs, "./figures"))
+    print(export_figures(specs, "./figures"))
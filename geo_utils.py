@@ -0,0 +1,232 @@
+import pandas as pd
+import numpy as np
+import os
+import json
+import hashlib
+import shapely
+from utils import _save_frame, _load_frame, _load_meta
+
+"""
+Utilities for joining sensor data with the GIS layers (city, canton and astra detector points)
+"""
+
+def sensor_coordinates(gdf, id_col="detid"):
+    """Coordinates of the detector points of a GIS layer, extracted for all points at once
+
+    Args:
+    - gdf: geo dataframe of detector points, e.g. read from the city, canton or astra layer
+    - id_col: column containing the detector ids
+
+    Returns:
+    - pd.DataFrame indexed by detector id with columns lat and lon (EPSG:4326)
+    """
+    if gdf.crs is not None and gdf.crs.to_epsg() != 4326:
+        gdf = gdf.to_crs("EPSG:4326")
+    return pd.DataFrame({"lat": gdf.geometry.y.to_numpy(), "lon": gdf.geometry.x.to_numpy()},
+                        index=pd.Index(gdf[id_col].to_numpy(), name=id_col))
+
+def join_sensor_values(gdf, values, id_col="detid"):
+    """Join aggregated sensor values with the detector points of a GIS layer, by a hash join on
+    the detector ids. Detectors missing on either side are dropped, the order of gdf is kept.
+
+    Args:
+    - gdf: geo dataframe of detector points, the result of sensor_coordinates, or a
+      registry.DetectorRegistry to join on the registry codes, in which case the order of the
+      registry is kept
+    - values: pd.Series or dict with keys being detector id, or pd.DataFrame indexed by detector
+      id (e.g. the result of utils.query_by_sensor) for several values per detector
+    - id_col: column containing the detector ids
+
+    Returns:
+    - lat: numpy array
+    - lon: numpy array
+    - z: numpy array of the values, of shape (detector,) or (detector, column) for a dataframe
+    """
+    if isinstance(values, dict):
+        values = pd.Series(values)
+    if hasattr(gdf, "codes"):
+        codes = gdf.codes(values.index)
+        positions = np.flatnonzero(codes >= 0)
+        positions = positions[np.argsort(codes[positions], kind="stable")]
+        lat, lon = gdf.coordinates(codes[positions])
+        return lat, lon, values.to_numpy()[positions]
+    coordinates = gdf if "lat" in gdf.columns and "lon" in gdf.columns else sensor_coordinates(gdf, id_col)
+    indexer = values.index.get_indexer(coordinates.index)
+    found = indexer >= 0
+    z = values.to_numpy()[indexer[found]]
+    return coordinates["lat"].to_numpy()[found], coordinates["lon"].to_numpy()[found], z
+
+def assign_districts(sensor_gdf, district_gdf, id_col="detid", district_col="id", cache_path=None):
+    """Assign every detector point to the district polygon containing it, using an STRtree over
+    the polygons. Points on a shared border go to the first district found.
+
+    Args:
+    - sensor_gdf: geo dataframe of detector points
+    - district_gdf: geo dataframe of district polygons
+    - id_col: column of sensor_gdf containing the detector ids
+    - district_col: column of district_gdf containing the district ids
+    - cache_path: .npz file to keep the assignment in. It is reused as long as it covers the
+      same detectors and districts (ids and geometries), if None, nothing is cached
+
+    Returns:
+    - pd.Series indexed by detector id with the district id, nan for detectors outside every district
+    """
+    ids = sensor_gdf[id_col].to_numpy()
+    if cache_path is not None:
+        h = hashlib.sha1(repr((district_col, str(district_gdf.crs), district_gdf[district_col].astype(str).tolist())).encode())
+        for wkb in shapely.to_wkb(district_gdf.geometry.to_numpy()):
+            h.update(wkb)
+        districts_hash = h.hexdigest()
+        if os.path.exists(cache_path) and _load_meta(cache_path).get("districts") == districts_hash:
+            cached = _load_frame(cache_path)
+            if len(cached) == len(ids) and (cached[id_col].to_numpy().astype(str) == ids.astype(str)).all():
+                return pd.Series(cached[district_col].to_numpy(), index=pd.Index(ids, name=id_col), name=district_col)
+
+    if sensor_gdf.crs is not None and district_gdf.crs is not None and sensor_gdf.crs != district_gdf.crs:
+        sensor_gdf = sensor_gdf.to_crs(district_gdf.crs)
+    tree = shapely.STRtree(district_gdf.geometry.to_numpy())
+    sensor_index, district_index = tree.query(sensor_gdf.geometry.to_numpy(), predicate="intersects")
+    # Keep the first district of every detector
+    sensor_index, first = np.unique(sensor_index, return_index=True)
+    district_ids = district_gdf[district_col].to_numpy()
+    assignment = pd.Series(np.nan, index=pd.Index(ids, name=id_col), name=district_col, dtype=object)
+    assignment.iloc[sensor_index] = district_ids[district_index[first]]
+    if district_ids.dtype != object:
+        assignment = assignment.astype(np.float64 if len(sensor_index) < len(ids) else district_ids.dtype)
+
+    if cache_path is not None:
+        # Missing districts are kept as nan by _save_frame
+        _save_frame(assignment.reset_index(), cache_path, meta={"districts": districts_hash})
+    return assignment
+
+def aggregate_by_district(assignment, values, districts=None, agg="mean"):
+    """Reduce per-detector values to per-district values, for all columns (e.g. time slices) at once
+
+    Args:
+    - assignment: result of assign_districts
+    - values: pd.Series or pd.DataFrame indexed by detector id, e.g. the result of utils.query_by_sensor
+    - districts: district ids giving the order of the result, e.g. district_gdf["id"]. If None,
+      only the districts containing detectors, sorted
+    - agg: reduction applied per district, e.g. "mean", "median", "sum", "count"
+
+    Returns:
+    - pd.Series or pd.DataFrame indexed by district id, nan for districts without detectors
+    """
+    district = assignment.reindex(values.index)
+    inside = district.notna().to_numpy()
+    result = values[inside].groupby(district[inside].to_numpy()).agg(agg)
+    if districts is not None:
+        result = result.reindex(districts)
+    return result
+
+# Serialized GeoJSON of recently used geo dataframes, see to_geojson
+_geojson_cache = {}
+GEOJSON_CACHE_SIZE = 8
+
+def to_geojson(gdf, id_col="id", simplify=None, grid_size=None):
+    """GeoJSON of a geo dataframe for plotly, keeping only the id property. The result is cached
+    on the geometries, ids and parameters, so figures drawn from the same polygons serialize them
+    only once. Do not modify the returned dict.
+
+    Args:
+    - gdf: geo dataframe
+    - id_col: column containing the ids referenced by the figure
+    - simplify: tolerance of the topology-preserving simplification, in units of the crs
+      (degrees for EPSG:4326). If None, geometries are kept as they are
+    - grid_size: precision the coordinates are snapped to, in units of the crs, e.g. 1e-5. If None,
+      full precision is kept
+
+    Returns:
+    - GeoJSON feature collection, a dict
+    """
+    h = hashlib.sha1()
+    h.update(b"".join(shapely.to_wkb(gdf.geometry.to_numpy())))
+    h.update(pd.util.hash_pandas_object(gdf[id_col], index=False).to_numpy().tobytes())
+    key = (h.hexdigest(), id_col, simplify, grid_size)
+    if key in _geojson_cache:
+        return _geojson_cache[key]
+
+    import geopandas as gpd
+    geometry = gdf.geometry.to_numpy()
+    if simplify is not None:
+        geometry = shapely.simplify(geometry, simplify, preserve_topology=True)
+    if grid_size is not None:
+        geometry = shapely.set_precision(geometry, grid_size)
+    reduced = gpd.GeoDataFrame({id_col: gdf[id_col].to_numpy()}, geometry=geometry, crs=gdf.crs)
+    geojson = json.loads(reduced.to_json(drop_id=True))
+
+    if len(_geojson_cache) >= GEOJSON_CACHE_SIZE:
+        del _geojson_cache[next(iter(_geojson_cache))]
+    _geojson_cache[key] = geojson
+    return geojson
+
+def bin_points(lat, lon, z, zoom, cell_px=20, kind="square", agg="mean"):
+    """Aggregate points into a square or hexagonal grid whose cells are about cell_px pixels wide
+    on a web map at the given zoom level
+
+    Args:
+    - lat, lon: array-like, coordinates of the points
+    - z: array-like, value of each point
+    - zoom: zoom level of the map, as for mapbox
+    - cell_px: width of a cell in pixels
+    - kind: {"square", "hex"}
+    - agg: {"mean", "sum", "count"}, reduction of the values in a cell
+
+    Returns:
+    - lat, lon: numpy arrays, centers of the non-empty cells
+    - value: numpy array, reduced value of every non-empty cell
+    - count: numpy array, number of points of every non-empty cell
+    - cell: numpy array, index of the cell of every point, to look up the points of a cell
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    z = np.asarray(z, dtype=np.float64)
+    # Web map tiles are 256 pixels wide and cover 360 degrees of longitude at zoom 0,
+    # latitudes are scaled around the mean latitude of the points
+    dx = 360.0 / 2 ** zoom / 256 * cell_px
+    dy = dx * np.cos(np.radians(np.nanmean(lat)))
+    x = lon / dx
+    y = lat / dy
+    if kind == "square":
+        i = np.floor(x).astype(np.int64)
+        j = np.floor(y).astype(np.int64)
+    elif kind == "hex":
+        # Axial coordinates of pointy-top hexagons of width 1, rounded through cube coordinates
+        size = 1 / np.sqrt(3)
+        q = (np.sqrt(3) / 3 * x - y / 3) / size
+        r = (2 / 3 * y) / size
+        s = -q - r
+        rq, rr, rs = np.round(q), np.round(r), np.round(s)
+        dq, dr, ds = np.abs(rq - q), np.abs(rr - r), np.abs(rs - s)
+        fix_q = (dq > dr) & (dq > ds)
+        fix_r = ~fix_q & (dr > ds)
+        rq = np.where(fix_q, -rr - rs, rq)
+        rr = np.where(fix_r, -rq - rs, rr)
+        i = rq.astype(np.int64)
+        j = rr.astype(np.int64)
+    else:
+        raise ValueError("Unknown kind " + str(kind) + ", choose from ['square', 'hex']")
+
+    cells, cell = np.unique(np.stack([i, j], axis=1), axis=0, return_inverse=True)
+    cell = cell.reshape(-1)
+    valid = ~np.isnan(z)
+    count = np.bincount(cell, minlength=len(cells))
+    if agg == "count":
+        value = count.astype(np.float64)
+    else:
+        value = np.bincount(cell[valid], weights=z[valid], minlength=len(cells))
+        if agg == "mean":
+            n = np.bincount(cell[valid], minlength=len(cells))
+            with np.errstate(invalid="ignore"):
+                value = value / n
+        elif agg != "sum":
+            raise ValueError("Unknown agg " + str(agg) + ", choose from ['mean', 'sum', 'count']")
+
+    if kind == "square":
+        center_x = cells[:, 0] + 0.5
+        center_y = cells[:, 1] + 0.5
+    else:
+        size = 1 / np.sqrt(3)
+        center_x = size * np.sqrt(3) * (cells[:, 0] + cells[:, 1] / 2)
+        center_y = size * 1.5 * cells[:, 1]
+    return center_y * dy, center_x * dx, value, count, cell
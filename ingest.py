@@ -0,0 +1,604 @@
+import pandas as pd
+import numpy as np
+import os
+import re
+from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from utils import _save_frame, _load_frame, _load_parts
+
+"""
+Utilities for parsing the raw data sets described in README.md
+"""
+
+# Columns of the canton VBV-1 records, in file order
+VBV_COLUMNS = ["site", "counter", "ddmmyy", "hhmm", "ss", "hh", "rescod", "lane", "direction",
+               "headway", "gap", "speed", "length", "class", "height"]
+VBV_DTYPES = {"site": np.int32, "counter": np.int64, "ddmmyy": str, "hhmm": str, "ss": np.int8, "hh": np.int8,
+              "rescod": str, "lane": np.int8, "direction": np.int8, "headway": np.float32, "gap": np.float32,
+              "speed": np.int16, "length": np.int32, "class": np.int8, "height": "category"}
+
+def read_vbv_header(path):
+    """Read the metadata frontmatter of a canton VBV-1 file, i.e. the "* KEY = VALUE" lines
+    between "* BEGIN" and the first record
+
+    Args:
+    - path: path to the file
+
+    Returns:
+    - A dict with keys being metadata name (e.g. "SITE", "STARTREC") and value being the stripped string
+    """
+    header = {}
+    with open(path, "r", errors="replace") as f:
+        for line in f:
+            if not line.startswith("*"):
+                break
+            if "=" in line:
+                key, value = line[1:].split("=", 1)
+                header[key.strip()] = value.strip()
+    return header
+
+def _decode_vbv(records):
+    """Turn raw VBV-1 records into a typed batch with a single timestamp column"""
+    timestamp = pd.to_datetime(records["ddmmyy"].str.zfill(6) + records["hhmm"].str.zfill(4), format="%d%m%y%H%M")
+    timestamp += pd.to_timedelta(records["ss"].to_numpy(np.int64) * 1000 + records["hh"].to_numpy(np.int64) * 10, unit="ms")
+    return pd.DataFrame({
+        "site": records["site"].to_numpy(),
+        "timestamp": timestamp.to_numpy(),
+        "lane": records["lane"].to_numpy(),
+        "direction": records["direction"].to_numpy(),
+        "headway": records["headway"].to_numpy(),
+        "gap": records["gap"].to_numpy(),
+        "speed": records["speed"].to_numpy(),
+        "length": records["length"].to_numpy(),
+        "class": records["class"].to_numpy(),
+        "height": records["height"].values,
+    })
+
+def read_vbv(path, chunksize=500000):
+    """Stream the vehicle records of a canton VBV-1 file in chunks. Records are whitespace
+    separated fixed-width rows, they are split by the C parser of pandas; lines starting
+    with "*" (frontmatter and column names) are skipped.
+
+    Args:
+    - path: path to the file
+    - chunksize: number of vehicles per batch
+
+    Returns:
+    - A generator of pd.DataFrame with columns site, timestamp, lane, direction, headway,
+      gap, speed, length, class, height
+    """
+    reader = pd.read_csv(path, delim_whitespace=True, comment="*", header=None, names=VBV_COLUMNS,
+                         dtype=VBV_DTYPES, chunksize=chunksize)
+    with reader:
+        for records in reader:
+            yield _decode_vbv(records)
+
+def _read_vbv_file(path, chunksize):
+    """Read a whole VBV-1 file, used by the worker processes of read_vbv_files"""
+    batches = list(read_vbv(path, chunksize))
+    if len(batches) == 0:
+        return read_vbv_header(path), _decode_vbv(pd.DataFrame({column: pd.Series(dtype=object) for column in VBV_COLUMNS}))
+    return read_vbv_header(path), pd.concat(batches, ignore_index=True)
+
+def read_vbv_files(paths, n_workers=None, chunksize=500000):
+    """Parse canton VBV-1 files in parallel, one file per process
+
+    Args:
+    - paths: list of file paths
+    - n_workers: number of processes, if None, use the number of cpus
+    - chunksize: number of vehicles parsed at once inside a worker
+
+    Returns:
+    - A generator of (path, header, data) in order of completion, see read_vbv_header and read_vbv
+    """
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {executor.submit(_read_vbv_file, path, chunksize): path for path in paths}
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Reading canton data"):
+            header, data = future.result()
+            yield futures[future], header, data
+
+def canton_detid(site, lane):
+    """Detector id of a canton lane as used in the GIS layer, e.g. canton_88_1"""
+    return "canton_" + str(site) + "_" + str(lane)
+
+def ingest_canton(path, out_dir, chunksize=500000):
+    """Ingest a canton VBV-1 file into per-detector partitions, i.e. one part file
+    out_dir/canton_<site>_<lane>/<file name>.npz per lane. A previous ingest of the same file is replaced.
+
+    Args:
+    - path: path to the VBV-1 file
+    - out_dir: directory of the partitioned output
+    - chunksize: number of vehicles parsed at once
+
+    Returns:
+    - A dict with keys being detector id and value being number of ingested vehicles
+    """
+    stem = os.path.basename(path)
+    _, vehicles = _read_vbv_file(path, chunksize)
+    rows = {}
+    for (site, lane), lane_vehicles in vehicles.groupby(["site", "lane"], sort=False):
+        detid = canton_detid(site, lane)
+        _save_frame(lane_vehicles.reset_index(drop=True), os.path.join(out_dir, detid, stem + ".npz"))
+        rows[detid] = len(lane_vehicles)
+    return rows
+
+def ingest_canton_files(paths, out_dir, n_workers=None, chunksize=500000):
+    """Ingest canton VBV-1 files in parallel, one file per process, see ingest_canton
+
+    Args:
+    - paths: list of file paths
+    - out_dir: directory of the partitioned output
+    - n_workers: number of processes, if None, use the number of cpus
+    - chunksize: number of vehicles parsed at once
+
+    Returns:
+    - A dict with keys being detector id and value being number of ingested vehicles
+    """
+    rows = {}
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(ingest_canton, path, out_dir, chunksize) for path in paths]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Ingesting canton data"):
+            for detid, n in future.result().items():
+                rows[detid] = rows.get(detid, 0) + n
+    return rows
+
+# Columns of the astra monthly files we use, and the compact dtypes they are loaded with.
+# Measurements are kept as float32 so that missing values survive.
+ASTRA_DTYPES = {"src_time": str, "zs_id": np.int32, "vd": np.int16, "vd_class_val": np.int16,
+                "vd_length_val": np.float32, "vd_speed_val": np.float32, "vd_occ_val": np.float32,
+                "vd_head_val": np.float32, "vd_gap_val": np.float32, "vd_dir": str}
+# Codes of vd_dir, as the direction column of the canton data (1 = normal, 2 = backward)
+ASTRA_DIRECTIONS = {"normal": 1, "reverse": 2, "backward": 2}
+
+def astra_detid(zs_id, vd):
+    """Detector id of an astra lane as used in the GIS layer, e.g. astra_2_1"""
+    return "astra_" + str(zs_id) + "_" + str(vd)
+
+def _parse_astra_time(src_time):
+    """Parse astra event times. Times with a UTC offset are converted to local Zurich time; the
+    offset changes within the months of the daylight saving time switch, so they are parsed as
+    UTC first. Times without an offset are taken as local times.
+    """
+    first = src_time.dropna()
+    if len(first) > 0 and re.search(r"(Z|[+-]\d{2}:?\d{2})$", str(first.iloc[0])):
+        timestamp = pd.to_datetime(src_time, utc=True, infer_datetime_format=True)
+        return timestamp.dt.tz_convert("Europe/Zurich").dt.tz_localize(None)
+    return pd.to_datetime(src_time, infer_datetime_format=True)
+
+def ingest_astra(path, out_dir, chunksize=1000000):
+    """Ingest an astra monthly file (e.g. 20_2021-01.csv) into per-detector partitions.
+    Only the needed columns are parsed, with compact dtypes, and the file is streamed in chunks
+    such that memory does not depend on the file size. Every chunk is written to
+    out_dir/astra_<zs_id>_<vd>/<file name>-<chunk>.npz; parts of a previous ingest of the same
+    file are replaced. vd_dir is kept as an int8 direction column coded as in the canton data,
+    -1 if unknown.
+
+    Args:
+    - path: path to the astra csv file
+    - out_dir: directory of the partitioned output
+    - chunksize: number of rows per chunk
+
+    Returns:
+    - A dict with keys being detector id and value being number of ingested rows
+    """
+    stem = os.path.splitext(os.path.basename(path))[0]
+    rows = {}
+    reader = pd.read_csv(path, usecols=list(ASTRA_DTYPES.keys()), dtype=ASTRA_DTYPES, chunksize=chunksize)
+    with reader:
+        for i, chunk in enumerate(reader):
+            chunk["src_time"] = _parse_astra_time(chunk["src_time"])
+            chunk["direction"] = chunk.pop("vd_dir").map(ASTRA_DIRECTIONS).fillna(-1).astype(np.int8)
+            for (zs_id, vd), vehicles in chunk.groupby(["zs_id", "vd"], sort=False):
+                detid = astra_detid(zs_id, vd)
+                part_dir = os.path.join(out_dir, detid)
+                if detid not in rows:
+                    rows[detid] = 0
+                    _remove_parts(part_dir, stem)
+                _save_frame(vehicles.reset_index(drop=True), os.path.join(part_dir, stem + "-" + str(i).zfill(5) + ".npz"))
+                rows[detid] += len(vehicles)
+    return rows
+
+def detector_directions(vehicle_dir):
+    """Direction of travel of the detectors of ingested canton or astra vehicles, the most
+    frequent direction in the first part file of every detector
+
+    Args:
+    - vehicle_dir: directory written by ingest_canton or ingest_astra
+
+    Returns:
+    - pd.Series indexed by detector id with the direction (1 = normal, 2 = backward), -1 if unknown
+    """
+    directions = {}
+    for detid in sorted(os.listdir(vehicle_dir)):
+        part_dir = os.path.join(vehicle_dir, detid)
+        names = sorted(name for name in os.listdir(part_dir) if name.endswith(".npz")) if os.path.isdir(part_dir) else []
+        if len(names) == 0:
+            continue
+        with np.load(os.path.join(part_dir, names[0]), allow_pickle=False) as f:
+            values = f["direction"] if "direction" in f.files else np.array([], dtype=np.int8)
+        values = values[values > 0]
+        directions[detid] = int(np.bincount(values).argmax()) if len(values) > 0 else -1
+    return pd.Series(directions, dtype=np.int8).rename_axis("detid")
+
+def _remove_parts(part_dir, stem):
+    """Remove the part files written from a source file in a partition directory"""
+    if not os.path.isdir(part_dir):
+        return
+    for name in os.listdir(part_dir):
+        if name.startswith(stem + "-") and name.endswith(".npz"):
+            os.remove(os.path.join(part_dir, name))
+
+def ingest_astra_files(paths, out_dir, n_workers=None, chunksize=1000000):
+    """Ingest astra monthly files in parallel, one file per process, see ingest_astra
+
+    Args:
+    - paths: list of file paths
+    - out_dir: directory of the partitioned output
+    - n_workers: number of processes, if None, use the number of cpus
+    - chunksize: number of rows per chunk
+
+    Returns:
+    - A dict with keys being detector id and value being number of ingested rows
+    """
+    rows = {}
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(ingest_astra, path, out_dir, chunksize) for path in paths]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Ingesting astra data"):
+            for detid, n in future.result().items():
+                rows[detid] = rows.get(detid, 0) + n
+    return rows
+
+def read_astra(out_dir, detid):
+    """Read the ingested vehicles of an astra detector
+
+    Args:
+    - out_dir: directory of the partitioned output of ingest_astra
+    - detid: detector id, e.g. astra_2_1
+
+    Returns:
+    - pd.DataFrame of the vehicles
+    """
+    return _load_parts(os.path.join(out_dir, detid))
+
+def easter_sunday(year):
+    """Date of Easter Sunday in the Gregorian calendar (anonymous Gregorian algorithm)"""
+    a = year % 19
+    b, c = divmod(year, 100)
+    d, e = divmod(b, 4)
+    g = (8 * b + 13) // 25
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 19 * l) // 433
+    month = (h + l - 7 * m + 90) // 25
+    day = (h + l - 7 * m + 33 * month + 19) % 32
+    return pd.Timestamp(year, month, day)
+
+def zurich_holidays(year):
+    """Public holidays of the canton of Zurich in a year
+
+    Args:
+    - year: int
+
+    Returns:
+    - pd.DatetimeIndex of the holidays
+    """
+    easter = easter_sunday(year)
+    fixed = [(1, 1), (1, 2), (5, 1), (8, 1), (12, 25), (12, 26)]
+    moving = [-2, 1, 39, 50] # Good Friday, Easter Monday, Ascension, Whit Monday
+    days = [pd.Timestamp(year, month, day) for month, day in fixed] + [easter + pd.Timedelta(days=n) for n in moving]
+    return pd.DatetimeIndex(sorted(days))
+
+def classify_days(dates):
+    """Classify dates into daytypes. Holidays take precedence over weekends.
+
+    Args:
+    - dates: array-like of datetime64 (days)
+
+    Returns:
+    - numpy array of {"workday", "weekend", "holiday"}
+    """
+    dates = pd.DatetimeIndex(dates)
+    holidays = pd.DatetimeIndex([])
+    for year in np.unique(dates.year):
+        holidays = holidays.append(zurich_holidays(int(year)))
+    daytype = np.where(dates.dayofweek >= 5, "weekend", "workday").astype(object)
+    daytype[dates.normalize().isin(holidays)] = "holiday"
+    return daytype
+
+DAYTYPES = ["workday", "weekend", "holiday"]
+CITY_DTYPES = {"day": str, "interval": np.int32, "detid": str, "flow": np.float32, "occ": np.float32,
+               "valid": np.int8, "suspect": np.int8}
+
+def _remove_city_parts(out_dir, stem):
+    """Remove everything written from a city yearly file by a previous split"""
+    for daytype in DAYTYPES:
+        daytype_dir = os.path.join(out_dir, daytype)
+        if not os.path.isdir(daytype_dir):
+            continue
+        for entry in os.scandir(daytype_dir):
+            if entry.is_dir():
+                _remove_parts(entry.path, stem)
+                if os.path.exists(os.path.join(entry.path, stem + ".npz")):
+                    os.remove(os.path.join(entry.path, stem + ".npz"))
+
+def _compact_parts(part_dir, stem):
+    """Merge the chunk parts of a source file in a partition directory into a single sorted part"""
+    names = sorted(name for name in os.listdir(part_dir) if name.startswith(stem + "-") and name.endswith(".npz"))
+    data = pd.concat([_load_frame(os.path.join(part_dir, name)) for name in names], ignore_index=True)
+    data = data.sort_values(["date", "interval"], kind="stable").reset_index(drop=True)
+    _save_frame(data, os.path.join(part_dir, stem + ".npz"))
+    for name in names:
+        os.remove(os.path.join(part_dir, name))
+
+def split_city_year(path, out_dir, chunksize=2000000, n_threads=None):
+    """Split a city yearly file (e.g. Zurich_2018_raw2.csv) into the layout read by read_from_ids,
+    i.e. out_dir/<daytype>/<detid>/, with one part file per yearly file. The file is streamed in
+    chunks such that memory does not depend on the file size: rows are classified into daytypes
+    with the Zurich holiday calendar, interval is converted into an hour column, and every chunk
+    is appended per detector and daytype as a part, the parts are merged at the end. Running it
+    again on the same file replaces its previous output.
+
+    Args:
+    - path: path to the city csv file
+    - out_dir: output directory
+    - chunksize: number of rows per chunk
+    - n_threads: number of threads used for merging the parts, if None, use the default of ThreadPoolExecutor, min(32, number of cpus + 4)
+
+    Returns:
+    - A dict with keys being daytype and value being number of rows
+    """
+    stem = os.path.splitext(os.path.basename(path))[0]
+    _remove_city_parts(out_dir, stem)
+    part_dirs = set()
+    rows = {daytype: 0 for daytype in DAYTYPES}
+    reader = pd.read_csv(path, usecols=list(CITY_DTYPES.keys()), dtype=CITY_DTYPES, chunksize=chunksize)
+    with reader:
+        for i, chunk in enumerate(reader):
+            # Every day appears many times in a chunk, parse and classify unique days only
+            codes, days = pd.factorize(chunk["day"])
+            days = pd.to_datetime(days, infer_datetime_format=True).normalize()
+            daytypes = classify_days(days)
+            data = pd.DataFrame({
+                "date": days.to_numpy()[codes],
+                "hour": (chunk["interval"].to_numpy() // 3600).astype(np.int8),
+                "interval": chunk["interval"].to_numpy(),
+                "flow": chunk["flow"].to_numpy(),
+                "occ": chunk["occ"].to_numpy(),
+                "valid": chunk["valid"].to_numpy(),
+                "suspect": chunk["suspect"].to_numpy(),
+            })
+            for (daytype, detid), sensor_data in data.groupby([daytypes[codes], chunk["detid"].to_numpy()], sort=False):
+                part_dir = os.path.join(out_dir, daytype, detid)
+                _save_frame(sensor_data.reset_index(drop=True), os.path.join(part_dir, stem + "-" + str(i).zfill(5) + ".npz"))
+                part_dirs.add(part_dir)
+                rows[daytype] += len(sensor_data)
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        list(executor.map(lambda part_dir: _compact_parts(part_dir, stem), part_dirs))
+    return rows
+
+def split_city_files(paths, out_dir, n_workers=None, chunksize=2000000):
+    """Split city yearly files in parallel, one file per process, see split_city_year
+
+    Args:
+    - paths: list of file paths
+    - out_dir: output directory
+    - n_workers: number of processes, if None, use the number of cpus
+    - chunksize: number of rows per chunk
+
+    Returns:
+    - A dict with keys being daytype and value being number of rows
+    """
+    rows = {daytype: 0 for daytype in DAYTYPES}
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(split_city_year, path, out_dir, chunksize, 1) for path in paths]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Splitting city data"):
+            for daytype, n in future.result().items():
+                rows[daytype] += n
+    return rows
+
+# Columns of the ingested vehicles of every source, and their units in SI (seconds, meters)
+VEHICLE_SOURCES = {
+    "canton": dict(time="timestamp", speed="speed", length="length", vehicle_class="class", occupied=None,
+                   length_unit=0.01, occupied_unit=None),
+    "astra": dict(time="src_time", speed="vd_speed_val", length="vd_length_val", vehicle_class="vd_class_val",
+                  occupied="vd_occ_val", length_unit=0.01, occupied_unit=0.001),
+}
+SPEED_BANDS = (0, 30, 50, 80, 100, 120, np.inf)
+VEHICLE_CLASSES = range(1, 11)
+
+def aggregate_vehicles(vehicles, source, interval=180, loop_length=2.0, speed_bands=SPEED_BANDS, classes=VEHICLE_CLASSES):
+    """Aggregate the vehicles of a detector into fixed time intervals, in the schema of the city
+    data read by read_from_ids. Every interval of the days with at least one vehicle is present,
+    intervals without vehicles on these days have a flow of 0. Days without any vehicle, e.g.
+    days missing from the raw files, have no intervals, so they stay missing instead of counting
+    as days without traffic.
+
+    The occupancy is the percentage of the interval during which the detector was covered. The
+    time a vehicle covers the detector is taken from the data if the source records it (astra),
+    otherwise it is estimated as (length + loop_length) / speed. Vehicles without a valid speed
+    count in the flow, and the occupancy of their interval is extrapolated from the other vehicles.
+    Vehicles without a time are left out.
+
+    Args:
+    - vehicles: pd.DataFrame of the vehicles of a detector, as written by ingest_canton or ingest_astra
+    - source: {"canton", "astra"}, see VEHICLE_SOURCES
+    - interval: length of the intervals in seconds, must divide a day, e.g. 180 as the city data or 3600
+    - loop_length: length of the detection zone in meters, used to estimate the occupancy
+    - speed_bands: edges of the speed bands (km/h) vehicles are counted in, if None, no speed bands
+    - classes: vehicle classes counted separately (SWISS10 by default), if None, no classes
+
+    Returns:
+    - pd.DataFrame with columns date, hour, interval (seconds from midnight to the end of the
+      interval, as in the city data), flow (vehicles per hour), occ, n (vehicles), speed_sum
+      (km/h, over the n_speed vehicles with a valid speed), n_speed, then the number of vehicles
+      per speed band (speed_<low>_<high>) and per class (class_<k>)
+    """
+    if 86400 % interval != 0:
+        raise ValueError("interval must divide a day, got " + str(interval))
+    columns = VEHICLE_SOURCES[source]
+    # Vehicles without a time, e.g. astra events with an empty src_time, cannot be placed in an interval
+    timed = vehicles[columns["time"]].notna().to_numpy()
+    if not timed.all():
+        vehicles = vehicles[timed]
+    timestamp = vehicles[columns["time"]].to_numpy().astype("datetime64[ns]")
+    speed = vehicles[columns["speed"]].to_numpy(dtype=np.float64)
+    if columns["occupied"] is not None:
+        occupied = vehicles[columns["occupied"]].to_numpy(dtype=np.float64) * columns["occupied_unit"]
+    else:
+        length = vehicles[columns["length"]].to_numpy(dtype=np.float64) * columns["length_unit"]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            occupied = (length + loop_length) / (speed / 3.6)
+    valid_speed = np.isfinite(speed) & (speed > 0)
+    valid_occupied = np.isfinite(occupied) & (occupied >= 0)
+
+    # Interval of every vehicle, counted over the intervals of the days covered by the vehicles
+    bins_per_day = 86400 // interval
+    seconds = timestamp.astype("datetime64[s]").astype(np.int64)
+    day = seconds // 86400
+    first_day = day.min() if len(day) else 0
+    present = np.bincount(day - first_day) > 0
+    covered = first_day + np.flatnonzero(present)
+    keys = (np.cumsum(present) - 1)[day - first_day] * bins_per_day + seconds % 86400 // interval
+    n_keys = len(covered) * bins_per_day
+
+    def count(weights=None, mask=None):
+        if mask is not None:
+            return np.bincount(keys[mask], weights=None if weights is None else weights[mask], minlength=n_keys)
+        return np.bincount(keys, weights=weights, minlength=n_keys)
+
+    n = count()
+    n_occupied = count(mask=valid_occupied)
+    occupied_sum = count(occupied, valid_occupied)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        occ = np.where(n == 0, 0.0, occupied_sum / n_occupied * n) * 100 / interval
+
+    days = np.repeat(covered * 86400, bins_per_day)
+    starts = days + np.tile(np.arange(bins_per_day) * interval, len(covered))
+    data = pd.DataFrame({
+        "date": days.astype("datetime64[s]").astype("datetime64[ns]"),
+        "hour": ((starts - days) // 3600).astype(np.int8),
+        "interval": (starts - days + interval - 1).astype(np.int32),
+        "flow": (n * 3600 / interval).astype(np.float32),
+        "occ": occ.astype(np.float32),
+        "n": n.astype(np.int32),
+        "speed_sum": count(speed, valid_speed).astype(np.float32),
+        "n_speed": count(mask=valid_speed).astype(np.int32),
+    })
+    if speed_bands is not None:
+        band = np.digitize(speed, speed_bands) - 1
+        for i in range(len(speed_bands) - 1):
+            name = "speed_" + str(speed_bands[i]) + "_" + str(speed_bands[i + 1])
+            data[name] = count(mask=valid_speed & (band == i)).astype(np.int32)
+    if classes is not None:
+        vehicle_class = vehicles[columns["vehicle_class"]].to_numpy()
+        for k in classes:
+            data["class_" + str(k)] = count(mask=vehicle_class == k).astype(np.int32)
+    return data
+
+def _part_month(name):
+    """Month "YYYY-MM" of the raw file an ingested vehicle part was written from, read from its
+    name (see ingest_canton and ingest_astra), None if the name is not recognized
+    """
+    match = re.match(r"^\d+_(\d{4}-\d{2})-\d+\.npz$", name)
+    if match:
+        return match.group(1)
+    match = re.match(r"^\d{4}(\d{2})(\d{2})\d{2}\.npz$", name)
+    if match:
+        return "20" + match.group(1) + "-" + match.group(2)
+    return None
+
+def convert_vehicles(part_dir, out_dir, source, interval=180, loop_length=2.0, months=None):
+    """Convert the ingested vehicles of a detector into intervals, see aggregate_vehicles, and
+    write them into the layout read by read_from_ids, i.e. out_dir/<daytype>/<detid>/<YYYY-MM>.npz.
+    A previous conversion of the detector, or of the given months, is replaced.
+
+    Args:
+    - part_dir: partition directory of the detector written by ingest_canton or ingest_astra
+    - out_dir: output directory
+    - source: {"canton", "astra"}
+    - interval: length of the intervals in seconds
+    - loop_length: length of the detection zone in meters
+    - months: list of months "YYYY-MM" to convert, e.g. the months of newly ingested files. Only
+      the parts of the raw files of these months and of the neighbouring months (vehicles may be
+      recorded in the file of the previous or next month) are read. If None, the whole history
+
+    Returns:
+    - A dict with keys being daytype and value being number of intervals
+    """
+    detid = os.path.basename(os.path.normpath(part_dir))
+    if months is None:
+        data = aggregate_vehicles(_load_parts(part_dir), source, interval, loop_length)
+    else:
+        months = set(months)
+        nearby = set(str(pd.Period(month, "M") + k) for month in months for k in (-1, 0, 1))
+        names = sorted(name for name in os.listdir(part_dir)
+                       if name.endswith(".npz") and _part_month(name) in nearby | {None})
+        vehicles = pd.concat([_load_frame(os.path.join(part_dir, name)) for name in names], ignore_index=True)
+        data = aggregate_vehicles(vehicles, source, interval, loop_length)
+        data = data[np.isin(data["date"].to_numpy().astype("datetime64[M]").astype(str), list(months))]
+    codes, days = pd.factorize(data["date"])
+    daytypes = classify_days(pd.DatetimeIndex(days))[codes]
+    months_of_rows = data["date"].dt.strftime("%Y-%m").to_numpy()
+    for daytype in DAYTYPES:
+        detector_dir = os.path.join(out_dir, daytype, detid)
+        if os.path.isdir(detector_dir):
+            for name in os.listdir(detector_dir):
+                if name.endswith(".npz") and (months is None or name[:-len(".npz")] in months):
+                    os.remove(os.path.join(detector_dir, name))
+    rows = {daytype: 0 for daytype in DAYTYPES}
+    for (daytype, month), interval_data in data.groupby([daytypes, months_of_rows], sort=False):
+        _save_frame(interval_data.reset_index(drop=True), os.path.join(out_dir, daytype, detid, month + ".npz"))
+        rows[daytype] += len(interval_data)
+    return rows
+
+def convert_vehicle_dirs(in_dir, out_dir, source, interval=180, loop_length=2.0, n_workers=None):
+    """Convert the ingested vehicles of all detectors in parallel, one detector per process, see convert_vehicles
+
+    Args:
+    - in_dir: directory of the partitioned output of ingest_canton_files or ingest_astra_files
+    - out_dir: output directory
+    - source: {"canton", "astra"}
+    - interval: length of the intervals in seconds
+    - loop_length: length of the detection zone in meters
+    - n_workers: number of processes, if None, use the number of cpus
+
+    Returns:
+    - A dict with keys being daytype and value being number of intervals
+    """
+    part_dirs = [entry.path for entry in os.scandir(in_dir) if entry.is_dir()]
+    rows = {daytype: 0 for daytype in DAYTYPES}
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(convert_vehicles, part_dir, out_dir, source, interval, loop_length) for part_dir in part_dirs]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Converting " + source + " vehicles"):
+            for daytype, n in future.result().items():
+                rows[daytype] += n
+    return rows
+
+# Testing
+if __name__ == "__main__":
+    canton_path = "./raw_data/canton/"
+    paths = [os.path.join(canton_path, name) for name in sorted(os.listdir(canton_path))]
+    print(read_vbv_header(paths[0]))
+    for path, header, data in read_vbv_files(paths[:4]):
+        print(path, header["SITE"], len(data))
+        print(data.head())
+
+    astra_path = "./raw_data/astra/"
+    paths = [os.path.join(astra_path, name) for name in sorted(os.listdir(astra_path))]
+    rows = ingest_astra_files(paths, "./preprocessed_data/astra_vehicles")
+    print(read_astra("./preprocessed_data/astra_vehicles", list(rows.keys())[0]).head())
+
+    city_path = "./raw_data/city/"
+    paths = [os.path.join(city_path, name) for name in sorted(os.listdir(city_path))]
+    print(split_city_files(paths, "./preprocessed_data/city"))
+
+    print(convert_vehicle_dirs("./preprocessed_data/canton_vehicles", "./preprocessed_data/canton", "canton"))
+    print(convert_vehicle_dirs("./preprocessed_data/astra_vehicles", "./preprocessed_data/astra", "astra"))
+
+    # Events with an empty src_time are parsed as NaT and left out of the intervals
+    vehicles = pd.DataFrame({"src_time": _parse_astra_time(pd.Series(["2021-01-01T08:00:00+01:00", None, "2021-01-01T08:01:00+01:00"])),
+                             "vd_speed_val": [80.0, 90.0, 100.0], "vd_length_val": [450.0, 450.0, 450.0],
+                             "vd_class_val": [3, 3, 3], "vd_occ_val": [200.0, 180.0, 160.0]})
+    print(aggregate_vehicles(vehicles, "astra", 3600)["n"].sum())
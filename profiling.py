@@ -0,0 +1,158 @@
+import os
+import json
+import time
+import threading
+import tracemalloc
+from functools import wraps
+
+"""
+Opt-in timing and memory instrumentation of the load, query and draw paths.
+
+Stages are wrapped in nested spans, used as context managers or decorators:
+
+    with span("my_stage"):
+        ...
+        add_rows(len(data))
+
+    @span("my_function")
+    def my_function(...):
+        ...
+
+Nothing is recorded until enable() is called, or the environment variable TRAFFIC_PROFILE
+is set to the path of a JSON lines file. Every finished span is kept in memory (see records and
+summary) and written as one JSON line if a path is given. Peak memory is measured with
+tracemalloc and only approximate while spans run concurrently in several threads.
+"""
+
+_state = dict(enabled=False, memory=False, path=None, records=[])
+_lock = threading.Lock()
+_local = threading.local()
+
+def enable(path=None, memory=False):
+    """Start recording spans
+
+    Args:
+    - path: JSON lines file every finished span is appended to, if None, spans are only kept in memory
+    - memory: whether to record the peak memory of every span with tracemalloc, slows Python down
+    """
+    _state.update(enabled=True, memory=memory, path=path)
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+def disable():
+    """Stop recording spans"""
+    if _state["memory"] and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _state.update(enabled=False, memory=False)
+
+def is_enabled():
+    """Whether spans are recorded"""
+    return _state["enabled"]
+
+def records():
+    """Finished spans, a list of dict with keys name, path, thread, start, seconds, rows and peak_mb"""
+    return list(_state["records"])
+
+def clear():
+    """Forget the finished spans kept in memory"""
+    del _state["records"][:]
+
+def _stack():
+    """Spans opened by the current thread"""
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+def add_rows(n):
+    """Count rows processed by the innermost open span of the current thread"""
+    if _state["enabled"]:
+        stack = _stack()
+        if stack:
+            stack[-1].rows += int(n)
+
+class span:
+    """A timed stage, see the module documentation. Spans opened in worker threads start a new
+    tree in that thread.
+
+    Args:
+    - name: name of the stage
+    """
+    def __init__(self, name):
+        self.name = name
+        self.active = False
+
+    def __enter__(self):
+        if not _state["enabled"]:
+            return self
+        self.active = True
+        self.rows = 0
+        self.peak = 0
+        stack = _stack()
+        self.path = (stack[-1].path + "/" if stack else "") + self.name
+        if _state["memory"] and tracemalloc.is_tracing():
+            # Hand the peak reached so far to the parent before measuring our own
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, peak)
+            tracemalloc.reset_peak()
+            self.base = current
+        stack.append(self)
+        self.start = time.time()
+        self.clock = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if not self.active:
+            return False
+        seconds = time.perf_counter() - self.clock
+        stack = _stack()
+        stack.pop()
+        record = dict(name=self.name, path=self.path, thread=threading.current_thread().name,
+                      start=self.start, seconds=seconds, rows=self.rows, peak_mb=None)
+        if _state["memory"] and tracemalloc.is_tracing():
+            self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            record["peak_mb"] = (self.peak - self.base) / 2**20
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, self.peak)
+        if stack:
+            stack[-1].rows += self.rows
+        with _lock:
+            _state["records"].append(record)
+            if _state["path"] is not None:
+                with open(_state["path"], "a") as f:
+                    f.write(json.dumps(record) + "\n")
+        self.active = False
+        return False
+
+    def __call__(self, function):
+        name = self.name
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _state["enabled"]:
+                return function(*args, **kwargs)
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+
+def summary(spans=None):
+    """Aggregate spans per path
+
+    Args:
+    - spans: list of span records, e.g. read from a JSON lines file. If None, the spans recorded in memory
+
+    Returns:
+    - pd.DataFrame indexed by path with count, total/mean/max seconds, rows and max peak memory
+    """
+    import pandas as pd
+    spans = pd.DataFrame(records() if spans is None else spans, columns=["name", "path", "thread", "start", "seconds", "rows", "peak_mb"])
+    table = spans.groupby("path").agg(count=("seconds", "size"), total_s=("seconds", "sum"), mean_s=("seconds", "mean"),
+                                      max_s=("seconds", "max"), rows=("rows", "sum"), peak_mb=("peak_mb", "max"))
+    return table.sort_values("total_s", ascending=False)
+
+def read_records(path):
+    """Read the spans of a JSON lines file written while profiling"""
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+if os.environ.get("TRAFFIC_PROFILE"):
+    enable(os.environ["TRAFFIC_PROFILE"], memory=os.environ.get("TRAFFIC_PROFILE_MEMORY", "") == "1")
@@ -0,0 +1,207 @@
+import pandas as pd
+import numpy as np
+import os
+import hashlib
+import pickle
+import weakref
+from collections import OrderedDict
+from utils import query
+
+"""
+Memoization of query results, for report code calling query with the same arguments many times
+"""
+
+# Columns query reads from a sensor dataframe, summed by _checksum
+QUERY_COLUMNS = ["date", "hour", "occ", "flow", "valid", "suspect"]
+
+def _checksum(data):
+    """Cheap content checksum of a sensor dataframe: the missing values per column, which decide
+    the complete rows, and the sums of the columns read by query
+    """
+    sums = []
+    for name in QUERY_COLUMNS:
+        if name in data.columns:
+            values = data[name].to_numpy()
+            if np.issubdtype(values.dtype, np.datetime64):
+                sums.append(int(values.view(np.int64).sum()))
+            else:
+                sums.append(float(np.nansum(values.astype(np.float64))))
+    return list(data.columns), data.isna().sum().tolist(), sums
+
+# Content digests by id of the dataframe they were computed for, dropped with the dataframe
+_digests = {}
+
+def _content_digest(data):
+    """Digest of the content of a dataframe, computed once per dataframe object: frames with a
+    source are summarized by _checksum, other frames (e.g. a rollup cube) are hashed. Frames are
+    not expected to be modified in place once queried.
+
+    Args:
+    - data: A dataframe
+
+    Returns:
+    - digest bytes
+    """
+    key = id(data)
+    entry = _digests.get(key)
+    if entry is not None and entry[0]() is data:
+        return entry[1]
+    h = hashlib.sha1()
+    if data.attrs.get("source") is not None and all(name in data.columns for name in QUERY_COLUMNS[:4]):
+        h.update(repr(_checksum(data)).encode())
+    else:
+        h.update(pd.util.hash_pandas_object(data, index=False).to_numpy().tobytes())
+        h.update(repr(list(data.columns)).encode())
+    digest = h.digest()
+    _digests[key] = (weakref.ref(data, lambda _, key=key: _digests.pop(key, None)), digest)
+    return digest
+
+def fingerprint(sensor_data):
+    """Stable fingerprint of a set of sensors. Dataframes read by read_from_ids are identified by
+    their source file, its modification time when they were loaded and their row range, together
+    with a checksum of their content, such that frames derived from them (e.g. by fillna) do not
+    share their results; other dataframes are hashed by content. Content digests are computed
+    once per dataframe object, so repeated lookups on the same frames stay cheap. A
+    PartitionedDataset is identified by its root and the modification times of its parts.
+
+    Args:
+    - sensor_data: A list of sensor data, a single dataframe such as a rollup cube, or a
+      dataset.PartitionedDataset
+
+    Returns:
+    - hex digest
+    """
+    from dataset import PartitionedDataset
+    h = hashlib.sha1()
+    if isinstance(sensor_data, PartitionedDataset):
+        parts = sensor_data.parts()
+        h.update(repr((os.path.abspath(sensor_data.root), [(part, os.stat(part).st_mtime_ns) for part in parts])).encode())
+        return h.hexdigest()
+    if isinstance(sensor_data, pd.DataFrame):
+        sensor_data = [sensor_data]
+    for data in sensor_data:
+        source = data.attrs.get("source")
+        if source is not None and all(name in data.columns for name in QUERY_COLUMNS[:4]):
+            first, last = (data.index[0], data.index[-1]) if len(data) > 0 else (None, None)
+            h.update(repr((source, data.attrs.get("mtime"), len(data), str(first), str(last), data.attrs.get("quality"))).encode())
+        h.update(_content_digest(data))
+    return h.hexdigest()
+
+def _nbytes(result):
+    """Memory used by a query result"""
+    if isinstance(result, dict):
+        return sum(_nbytes(value) for value in result.values())
+    return int(result.memory_usage(index=True, deep=True).sum())
+
+def _copy(result):
+    """Copy a query result such that callers cannot modify the cached one"""
+    if isinstance(result, dict):
+        return {key: value.copy() for key, value in result.items()}
+    return result.copy()
+
+class QueryCache:
+    """LRU cache of query results, bounded by number of entries and by memory. Results can
+    also be persisted in a directory, shared across processes.
+
+    Args:
+    - max_entries: maximum number of results kept in memory
+    - max_bytes: maximum memory used by the results kept in memory
+    - path: directory for persisting results, if None, results are only kept in memory
+    """
+    def __init__(self, max_entries=256, max_bytes=256 * 2**20, path=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.path = path
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    def key(self, sensor_data, begin, end, scale, quality=None, ids=None, source=None, daytype=None):
+        """Cache key of a query"""
+        scales = (scale,) if isinstance(scale, str) else tuple(scale)
+        params = repr((str(pd.Timestamp(begin)), str(pd.Timestamp(end)), scales, quality,
+                       None if ids is None else list(ids), source, daytype))
+        return hashlib.sha1((fingerprint(sensor_data) + params).encode()).hexdigest()
+
+    def query(self, sensor_data, begin, end, scale, quality=None, ids=None, source=None, daytype=None):
+        """Same as utils.query, answered from the cache when possible"""
+        key = self.key(sensor_data, begin, end, scale, quality, ids, source, daytype)
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return _copy(self.entries[key])
+
+        disk_path = os.path.join(self.path, key + ".pkl") if self.path is not None else None
+        if disk_path is not None and os.path.exists(disk_path):
+            self.disk_hits += 1
+            with open(disk_path, "rb") as f:
+                result = pickle.load(f)
+        else:
+            self.misses += 1
+            result = query(sensor_data, begin, end, scale, quality, ids, source, daytype)
+            if disk_path is not None:
+                with open(disk_path + ".tmp", "wb") as f:
+                    pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(disk_path + ".tmp", disk_path)
+        self._store(key, result)
+        return _copy(result)
+
+    def _store(self, key, result):
+        """Keep a result in memory and evict the least recently used ones beyond the limits"""
+        size = _nbytes(result)
+        if size > self.max_bytes:
+            return
+        self.entries[key] = result
+        self.nbytes += size
+        while len(self.entries) > self.max_entries or self.nbytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= _nbytes(evicted)
+            self.evictions += 1
+
+    def stats(self):
+        """Counters of the cache, for tuning its limits"""
+        return dict(hits=self.hits, disk_hits=self.disk_hits, misses=self.misses, evictions=self.evictions,
+                    entries=len(self.entries), nbytes=self.nbytes)
+
+    def clear(self, disk=False):
+        """Drop the results kept in memory, and the persisted ones if disk"""
+        self.entries.clear()
+        self.nbytes = 0
+        if disk and self.path is not None:
+            for name in os.listdir(self.path):
+                if name.endswith(".pkl"):
+                    os.remove(os.path.join(self.path, name))
+
+default_cache = QueryCache()
+
+def cached_query(sensor_data, begin, end, scale, cache=None, quality=None, ids=None, source=None, daytype=None):
+    """Same as utils.query, memoized by a QueryCache
+
+    Args:
+    - sensor_data, begin, end, scale, quality, ids, source, daytype: see utils.query
+    - cache: QueryCache to use, if None, use the module-level default cache
+
+    Returns:
+    - see utils.query
+    """
+    if cache is None:
+        cache = default_cache
+    return cache.query(sensor_data, begin, end, scale, quality, ids, source, daytype)
+
+# Testing
+if __name__ == "__main__":
+    from datetime import datetime
+    from utils import read_from_ids
+    id_path = "./preprocessed_data/city/city_id.csv"
+    data_path = "./preprocessed_data/city"
+    id = list(pd.read_csv(id_path)["detid"])
+    weekend_df_dict = read_from_ids(id, "weekend", data_path)
+    cache = QueryCache(path="./preprocessed_data/query_cache")
+    for year in [2018, 2019, 2018, 2019]:
+        cache.query(list(weekend_df_dict.values()), datetime(year,1,1), datetime(year+1,1,1), "month")
+    print(cache.stats())
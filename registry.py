@@ -0,0 +1,153 @@
+import pandas as pd
+import numpy as np
+from utils import _save_frame, _load_frame
+
+"""
+Registry of the detectors of all three networks, giving every detector a dense int32 code.
+
+Detector ids are strings of the form canton_<site>_<lane>, astra_<site>_<lane> and, for the
+city, <site>.<detector> (e.g. K2.D11). The registry keeps, per code:
+- detid: detector id
+- source: "city", "canton" or "astra"
+- site, lane: the parts of the detector id
+- direction: direction of travel, -1 if unknown
+- type: detector type of the GIS layer (e.g. IMP), "" if unknown
+- lat, lon: coordinates (EPSG:4326), nan if unknown
+
+Codes never change once assigned, new detectors are appended. Sensor ids can be carried as codes
+or as pandas categoricals whose codes are the registry codes (see categorical), which makes
+grouping and joining on them integer operations.
+"""
+
+REGISTRY_COLUMNS = ["detid", "source", "site", "lane", "direction", "type", "lat", "lon"]
+
+def parse_detid(ids):
+    """Split detector ids into source, site and lane
+
+    Args:
+    - ids: list of detector ids
+
+    Returns:
+    - pd.DataFrame with columns detid, source, site and lane
+    """
+    ids = pd.Series(np.asarray(ids, dtype=object), dtype=object)
+    parts = ids.str.extract(r"^(canton|astra)_([^_]+)_(.+)$")
+    city = parts[0].isna().to_numpy()
+    city_parts = ids[city].str.extract(r"^([^.]*)\.?(.*)$")
+    parts.loc[city, 0] = "city"
+    parts.loc[city, 1] = city_parts[0].to_numpy()
+    parts.loc[city, 2] = city_parts[1].to_numpy()
+    return pd.DataFrame({"detid": ids.to_numpy(), "source": parts[0].to_numpy(), "site": parts[1].to_numpy(),
+                         "lane": parts[2].to_numpy()})
+
+class DetectorRegistry:
+    """Detector registry, see the module documentation. Build it with build_registry or load_registry."""
+    def __init__(self, table):
+        self.table = table[REGISTRY_COLUMNS].reset_index(drop=True)
+        self.detids = pd.Index(self.table["detid"].to_numpy(), name="detid")
+        if not self.detids.is_unique:
+            raise ValueError("Duplicate detector ids in registry")
+
+    def __len__(self):
+        return len(self.table)
+
+    def codes(self, ids):
+        """Codes of detector ids, -1 for unknown ids
+
+        Args:
+        - ids: list of detector ids, or a categorical of them
+
+        Returns:
+        - int32 numpy array
+        """
+        if isinstance(ids, (pd.Categorical, pd.CategoricalIndex)) and ids.categories.equals(self.detids):
+            return np.asarray(ids.codes, dtype=np.int32)
+        return self.detids.get_indexer(ids).astype(np.int32)
+
+    def ids(self, codes):
+        """Detector ids of codes"""
+        return self.detids.to_numpy()[np.asarray(codes)]
+
+    def categorical(self, ids):
+        """Detector ids as a pandas categorical whose codes are the registry codes, nan for unknown ids"""
+        return pd.Categorical.from_codes(self.codes(ids), categories=self.detids)
+
+    def coordinates(self, codes):
+        """Latitude and longitude of codes, as numpy arrays"""
+        return self.table["lat"].to_numpy()[codes], self.table["lon"].to_numpy()[codes]
+
+    def add(self, ids, direction=None, type=None, lat=None, lon=None):
+        """Register new detectors, ids already in the registry keep their code and attributes
+
+        Args:
+        - ids: list of detector ids
+        - direction, type, lat, lon: optional arrays of attributes, aligned with ids
+
+        Returns:
+        - int32 numpy array of the codes of ids
+        """
+        ids = np.asarray(ids, dtype=object)
+        new = pd.Index(ids).unique().difference(self.detids, sort=False) if len(self) else pd.Index(ids).unique()
+        if len(new) > 0:
+            table = parse_detid(new)
+            attributes = {"direction": (direction, -1), "type": (type, ""), "lat": (lat, np.nan), "lon": (lon, np.nan)}
+            for name, (values, default) in attributes.items():
+                if values is None:
+                    table[name] = default
+                else:
+                    table[name] = pd.Series(np.asarray(values), index=ids).groupby(level=0).first().reindex(new, fill_value=default).to_numpy()
+            table = pd.concat([self.table, table], ignore_index=True)
+            table["direction"] = table["direction"].astype(np.int8)
+            self.__init__(table)
+        return self.codes(ids)
+
+    def save(self, path):
+        """Save the registry to a .npz file"""
+        _save_frame(self.table, path)
+
+def build_registry(layers, type_col="type", direction_col="direction", directions=None):
+    """Build a registry from the GIS layers of detector points
+
+    Args:
+    - layers: list of geo dataframes of detector points with a detid column, e.g. the city, canton
+      and astra layers. Their order gives the order of the codes
+    - type_col: column holding the detector type, ignored where missing
+    - direction_col: column holding the direction of travel, ignored where missing
+    - directions: pd.Series indexed by detector id with the direction of travel, used for the
+      layers without direction_col, e.g. ingest.detector_directions of the canton and astra vehicles
+
+    Returns:
+    - DetectorRegistry
+    """
+    from geo_utils import sensor_coordinates
+    registry = DetectorRegistry(pd.DataFrame({column: [] for column in REGISTRY_COLUMNS}))
+    for gdf in layers:
+        coordinates = sensor_coordinates(gdf)
+        if direction_col in gdf.columns:
+            direction = gdf[direction_col].to_numpy()
+        elif directions is not None:
+            direction = directions.reindex(gdf["detid"].to_numpy(), fill_value=-1).to_numpy()
+        else:
+            direction = None
+        registry.add(gdf["detid"].to_numpy(),
+                     direction=direction,
+                     type=gdf[type_col].astype(str).to_numpy() if type_col in gdf.columns else None,
+                     lat=coordinates["lat"].to_numpy(), lon=coordinates["lon"].to_numpy())
+    return registry
+
+def load_registry(path):
+    """Load a registry saved by DetectorRegistry.save"""
+    table = _load_frame(path)
+    table["direction"] = table["direction"].astype(np.int8)
+    return DetectorRegistry(table)
+
+# Testing
+if __name__ == "__main__":
+    import geopandas as gpd
+    from ingest import detector_directions
+    layers = [gpd.read_file("./spatial/loop_update_city/"), gpd.read_file("./spatial/canton/"), gpd.read_file("./spatial/astra/")]
+    directions = pd.concat([detector_directions("./preprocessed_data/canton_vehicles"),
+                            detector_directions("./preprocessed_data/astra_vehicles")])
+    registry = build_registry(layers, directions=directions)
+    registry.save("./preprocessed_data/registry.npz")
+    print(load_registry("./preprocessed_data/registry.npz").table.groupby("source").size())
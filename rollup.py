@@ -0,0 +1,232 @@
+import pandas as pd
+import numpy as np
+import os
+import json
+from utils import _save_frame, _load_frame, _load_meta, _scale_key, _by_scale, _check_scales, _quality_mask
+
+"""
+Precomputed rollup cube of sensor data, so that repeated queries on different time ranges
+do not rescan the raw rows.
+
+The cube holds partial aggregates per (sensor, daytype, date, hour) bucket:
+- n: number of rows
+- n_occ, s_occ, ss_occ, n_flow, s_flow, ss_flow: count, sum and sum of squares of the
+  non-missing values, used by the hour scale
+- nc, cs_occ, css_occ, cs_flow, css_flow: the same over rows without any missing value, used
+  by the day, week and month scales (query drops incomplete rows for them)
+Every scale of query can be answered by summing buckets, and new days are merged in by adding
+their buckets to the cube. A cube built with a quality policy only holds the rows passing it, the
+policy is kept in cube.attrs["quality"].
+"""
+
+KEYS = ["sensor", "daytype", "date", "hour"]
+STATS = ["n", "n_occ", "s_occ", "ss_occ", "n_flow", "s_flow", "ss_flow",
+         "nc", "cs_occ", "css_occ", "cs_flow", "css_flow"]
+
+def is_rollup(data):
+    """Whether data is a rollup cube"""
+    return isinstance(data, pd.DataFrame) and set(KEYS + STATS).issubset(data.columns)
+
+def _buckets(date, hour, occ, flow, complete):
+    """Partial aggregates STATS of rows per (date, hour) bucket
+
+    Args:
+    - date, hour, occ, flow: numpy arrays of the rows
+    - complete: boolean numpy array, whether the row has no missing value
+
+    Returns:
+    - pd.DataFrame with columns date, hour and STATS
+    """
+    columns = {"date": date, "hour": hour, "n": np.ones(len(date), dtype=np.int64)}
+    for metric, values in [("occ", occ), ("flow", flow)]:
+        valid = ~np.isnan(values)
+        filled = np.where(valid, values, 0.0)
+        columns["n_" + metric] = valid.astype(np.int64)
+        columns["s_" + metric] = filled
+        columns["ss_" + metric] = filled ** 2
+        columns["cs_" + metric] = np.where(complete, filled, 0.0)
+        columns["css_" + metric] = np.where(complete, filled ** 2, 0.0)
+    columns["nc"] = complete.astype(np.int64)
+    return pd.DataFrame(columns).groupby(["date", "hour"], sort=False).sum().reset_index()
+
+def build_rollup(data_dict, daytype, registry=None, quality=None):
+    """Build the rollup cube of a set of sensors
+
+    Args:
+    - data_dict: dict with keys being sensor id and value being sensor dataframe, as returned by read_from_ids
+    - daytype: {"workday", "weekend", "holiday"}, the daytype of the data
+    - registry: if given, a registry.DetectorRegistry, the sensor column is then a categorical
+      whose codes are the registry codes instead of repeated strings. Sensors missing from the
+      registry are added to it
+    - quality: quality policy on the valid/suspect flags (see utils.read_from_ids), failing rows
+      are left out of the buckets
+
+    Returns:
+    - Rollup cube, a pd.DataFrame with columns KEYS + STATS
+    """
+    buckets = []
+    codes = registry.add(list(data_dict)) if registry is not None else None
+    for i, (id, data) in enumerate(data_dict.items()):
+        complete = data.notna().all(axis=1).to_numpy()
+        mask = _quality_mask(data, quality)
+        if mask is not None:
+            data, complete = data[mask], complete[mask]
+        sensor_buckets = _buckets(data["date"].to_numpy(), data["hour"].to_numpy(), data["occ"].to_numpy(dtype=np.float64),
+                                  data["flow"].to_numpy(dtype=np.float64), complete)
+        if registry is None:
+            sensor_buckets.insert(0, "sensor", id)
+        else:
+            sensor_buckets.insert(0, "sensor", pd.Categorical.from_codes(np.full(len(sensor_buckets), codes[i]), categories=registry.detids))
+        sensor_buckets.insert(1, "daytype", daytype)
+        buckets.append(sensor_buckets)
+    if len(buckets) == 0:
+        cube = pd.DataFrame({column: [] for column in KEYS + STATS})
+    else:
+        cube = pd.concat(buckets, ignore_index=True)[KEYS + STATS]
+    cube.attrs["quality"] = repr(quality)
+    return cube
+
+def update_rollup(cube, data_dict, daytype, registry=None, quality=None):
+    """Merge new sensor data into a rollup cube. The new rows are added to the existing buckets,
+    so only pass data that is not yet part of the cube, e.g. newly arrived days.
+
+    Args:
+    - cube: rollup cube
+    - data_dict: dict with keys being sensor id and value being the new sensor dataframe
+    - daytype: {"workday", "weekend", "holiday"}, the daytype of the new data
+    - registry: if given, a registry.DetectorRegistry, see build_rollup
+    - quality: quality policy the cube was built with, see build_rollup
+
+    Returns:
+    - Updated rollup cube
+    """
+    return merge_rollups([cube, build_rollup(data_dict, daytype, registry, quality)])
+
+def merge_rollups(cubes):
+    """Merge rollup cubes by summing the buckets they have in common, they must be built with
+    the same quality policy
+
+    Args:
+    - cubes: list of rollup cubes
+
+    Returns:
+    - Merged rollup cube
+    """
+    cubes = [cube for cube in cubes if len(cube) > 0]
+    if len(cubes) == 0:
+        return build_rollup({}, None)
+    qualities = set(cube.attrs.get("quality", repr(None)) for cube in cubes)
+    if len(qualities) > 1:
+        raise ValueError("Cannot merge rollup cubes built with different quality policies " + str(sorted(qualities)))
+    # Registries only grow, so the categories of every cube are a prefix of the longest ones. The
+    # sensors of cubes built without a registry are appended to them, as a registry would add them
+    dtypes = [cube["sensor"].dtype for cube in cubes if isinstance(cube["sensor"].dtype, pd.CategoricalDtype)]
+    if len(dtypes) > 0:
+        categories = max(dtypes, key=lambda dtype: len(dtype.categories)).categories
+        plain = [cube["sensor"] for cube in cubes if not isinstance(cube["sensor"].dtype, pd.CategoricalDtype)]
+        if len(plain) > 0:
+            categories = categories.append(pd.Index(pd.concat(plain).unique()).difference(categories, sort=False))
+        dtype = pd.CategoricalDtype(categories)
+        cubes = [cube.assign(sensor=cube["sensor"].astype(dtype)) for cube in cubes]
+    merged = pd.concat(cubes, ignore_index=True)
+    merged = merged.groupby(KEYS, sort=False, observed=True)[STATS].sum().reset_index()
+    if len(dtypes) > 0:
+        # groupby without sorting reorders the categories, restore the registry codes
+        merged["sensor"] = merged["sensor"].cat.reorder_categories(dtype.categories)
+    merged.attrs["quality"] = qualities.pop()
+    return merged
+
+def save_rollup(cube, path):
+    """Save a rollup cube and its quality policy to a .npz file. A categorical sensor column is
+    stored as its int32 codes, with the categories kept in the file
+    """
+    meta = {"quality": cube.attrs.get("quality", repr(None))}
+    if isinstance(cube["sensor"].dtype, pd.CategoricalDtype):
+        meta["sensor_categories"] = json.dumps([str(id) for id in cube["sensor"].cat.categories])
+        cube = cube.assign(sensor=cube["sensor"].cat.codes.to_numpy().astype(np.int32))
+    _save_frame(cube, path, meta=meta)
+
+def load_rollup(path, registry=None):
+    """Load a rollup cube saved by save_rollup, an empty cube is returned if the file does not exist
+
+    Args:
+    - path: path to the .npz file
+    - registry: if given, a registry.DetectorRegistry, the sensor column is then a categorical
+      whose codes are the registry codes, sensors missing from the registry are added to it.
+      Otherwise the sensor column is a categorical only if it was saved as one
+
+    Returns:
+    - Rollup cube
+    """
+    if not os.path.exists(path):
+        cube = build_rollup({}, None)
+    else:
+        cube = _load_frame(path)
+        meta = _load_meta(path)
+        cube.attrs["quality"] = meta.get("quality", repr(None))
+        if "sensor_categories" in meta:
+            cube["sensor"] = pd.Categorical.from_codes(cube["sensor"].to_numpy(), categories=json.loads(meta["sensor_categories"]))
+    if registry is not None:
+        sensors = cube["sensor"].astype("category").array
+        codes = registry.add(list(sensors.categories))[sensors.codes]
+        cube["sensor"] = pd.Categorical.from_codes(codes, categories=registry.detids)
+    return cube
+
+def _reduce(buckets, scale, with_std):
+    """Merge the buckets for a scale into mean (and std) of occupancy and flow"""
+    prefix = "" if scale == "hour" else "c"
+    count_columns = {"occ": "n_occ", "flow": "n_flow"} if scale == "hour" else {"occ": "nc", "flow": "nc"}
+    if scale != "hour":
+        buckets = buckets[buckets["nc"].to_numpy() > 0]
+    key = _scale_key(buckets, scale).rename("date" if scale == "day" else scale)
+    sums = buckets[STATS].groupby(key).sum()
+
+    agg_data = pd.DataFrame(index=sums.index)
+    for metric in ["occ", "flow"]:
+        n = sums[count_columns[metric]].to_numpy(dtype=np.float64)
+        s = sums[prefix + "s_" + metric].to_numpy()
+        with np.errstate(invalid="ignore", divide="ignore"):
+            agg_data[metric] = s / n
+            if with_std:
+                ss = sums[prefix + "ss_" + metric].to_numpy()
+                var = (ss - s ** 2 / n) / (n - 1)
+                agg_data[metric + "_std"] = np.sqrt(np.maximum(var, 0.0))
+    return agg_data.reset_index()
+
+def query_rollup(cube, begin, end, scale, ids=None, daytype=None, with_std=False):
+    """Query the aggregated data from a rollup cube in (begin, end) for a scale. Gives the same
+    statistics as utils.query on the raw sensor data.
+
+    Args:
+    - cube: rollup cube
+    - begin, end: datetime
+    - scale: {hour, day, week, month}, or a list of them
+    - ids: list of sensor ids to consider, if None, use all sensors in the cube
+    - daytype: daytype to consider, if None, use all daytypes in the cube
+    - with_std: whether to also return the standard deviations "occ_std" and "flow_std"
+
+    Returns:
+    - Statistics(a pd.DataFrame) on these sensors during a specific time range. If a list of
+      scales is given, a dict with keys being scale and value being corresponding statistics
+    """
+    _check_scales(scale)
+    mask = ((cube["date"] >= begin) & (cube["date"] < end)).to_numpy()
+    if ids is not None:
+        mask &= cube["sensor"].isin(ids).to_numpy()
+    if daytype is not None:
+        mask &= (cube["daytype"] == daytype).to_numpy()
+    buckets = cube[mask]
+    return _by_scale(scale, lambda s: _reduce(buckets, s, with_std))
+
+# Testing
+if __name__ == "__main__":
+    from datetime import datetime
+    from utils import read_from_ids
+    id_path = "./preprocessed_data/city/city_id.csv"
+    data_path = "./preprocessed_data/city"
+    cube_path = "./preprocessed_data/city/rollup.npz"
+    id = list(pd.read_csv(id_path)["detid"])
+    weekend_df_dict = read_from_ids(id, "weekend", data_path)
+    cube = build_rollup(weekend_df_dict, "weekend")
+    save_rollup(cube, cube_path)
+    print(query_rollup(load_rollup(cube_path), datetime(2018,1,1), datetime(2018,2,1), "hour", with_std=True))
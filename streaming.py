@@ -0,0 +1,267 @@
+import pandas as pd
+import numpy as np
+from utils import SCALES, _stack, _scale_key, _save_frame, _load_frame, _load_meta, relative, normalize
+
+"""
+Incremental statistics of continuously arriving sensor data.
+
+An OnlineStats holds, per (sensor, daytype, bucket) with bucket a key of a query scale (e.g.
+the hour of day), the count, mean and sum of squared deviations (M2) of occupancy and flow.
+New batches are folded in with the parallel variant of Welford's algorithm (Chan et al.),
+and an update only merges the buckets the new rows fall into, appending the buckets seen for
+the first time. Memory only depends on the number of buckets. States computed by parallel
+workers on different data are merged the same way.
+
+The statistics follow utils.query: the hour scale ignores missing values per metric, the day,
+week and month scales only use rows without any missing value.
+"""
+
+METRICS = ["occ", "flow"]
+
+def _combine(states, keys):
+    """Combine the moments of rows with the same keys, with the numerically stable pairwise formula"""
+    non_empty = [state for state in states if len(state) > 0]
+    if len(non_empty) == 0:
+        return states[0]
+    states = pd.concat(non_empty, ignore_index=True)
+    groups = states.groupby(keys, sort=True)
+    combined = {}
+    for metric in METRICS:
+        n, mean, m2 = states["n_" + metric], states["mean_" + metric], states["m2_" + metric]
+        total = groups["n_" + metric].transform("sum")
+        weighted = (n * mean).groupby([states[key] for key in keys]).transform("sum")
+        total_mean = (weighted / total.where(total > 0)).fillna(0.0)
+        deviations = m2 + n * (mean - total_mean) ** 2
+        combined["n_" + metric] = total
+        combined["mean_" + metric] = total_mean
+        combined["m2_" + metric] = deviations
+    combined = pd.DataFrame(combined)
+    for key in keys:
+        combined[key] = states[key]
+    sums = combined.groupby(keys, sort=True).agg(
+        **{name: (name, "first" if name.startswith("n_") or name.startswith("mean_") else "sum") for name in combined.columns if name not in keys})
+    return sums.reset_index()
+
+def _merge_moments(n_a, mean_a, m2_a, n_b, mean_b, m2_b):
+    """Count, mean and M2 of the union of two sets of values given by their moments, elementwise"""
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    with np.errstate(invalid="ignore", divide="ignore"):
+        weight = np.where(n > 0, n_b / n, 0.0)
+    return n, mean_a + delta * weight, m2_a + m2_b + delta ** 2 * n_a * weight
+
+def _moments(frame, keys):
+    """Count, mean and M2 of the metrics of the rows of frame per keys, missing values ignored"""
+    groups = frame.groupby(keys, sort=True)
+    moments = {}
+    for metric in METRICS:
+        n = groups[metric].count()
+        moments["n_" + metric] = n.astype(np.int64)
+        moments["mean_" + metric] = groups[metric].mean().fillna(0.0)
+        moments["m2_" + metric] = (groups[metric].var(ddof=0) * n).fillna(0.0)
+    return pd.DataFrame(moments).reset_index()
+
+class OnlineStats:
+    """Mergeable running statistics of sensor data, see the module documentation
+
+    Args:
+    - scale: {hour, day, week, month}, the buckets of the statistics
+    - state: pd.DataFrame of a previous state, e.g. from load_stats
+    """
+    def __init__(self, scale="hour", state=None):
+        if scale not in SCALES:
+            raise ValueError("Unknown scale " + str(scale) + ", choose from " + str(SCALES))
+        self.scale = scale
+        self.key = "date" if scale == "day" else scale
+        self.keys = ["sensor", "daytype", self.key]
+        if state is None:
+            state = pd.DataFrame({name: [] for name in self.keys + [stat + "_" + metric for metric in METRICS for stat in ["n", "mean", "m2"]]})
+        self.state = state
+        self._index = None
+
+    def _state_index(self):
+        """Index of the keys of the state, rebuilt when the state was replaced"""
+        if self._index is None or self._index[0] is not self.state:
+            self._index = (self.state, pd.MultiIndex.from_frame(self.state[self.keys]))
+        return self._index[1]
+
+    def update(self, data_dict, daytype, quality=None):
+        """Fold a batch of new rows into the statistics. Only pass rows that have not been seen yet.
+
+        Args:
+        - data_dict: dict with keys being sensor id and value being the new rows of the sensor
+        - daytype: {"workday", "weekend", "holiday"}, the daytype of the rows
+        - quality: quality policy on the valid/suspect flags (see utils.read_from_ids), failing
+          rows are left out of the statistics
+
+        Returns:
+        - self
+        """
+        if len(data_dict) == 0:
+            return self
+        ids = np.asarray(list(data_dict.keys()), dtype=object)
+        stacked = _stack(list(data_dict.values()), pd.Timestamp.min, pd.Timestamp.max,
+                         with_complete=self.scale != "hour", with_sensor=True, quality=quality)
+        if self.scale != "hour":
+            stacked = stacked[stacked["complete"].to_numpy()]
+        batch = pd.DataFrame({"sensor": ids[stacked["sensor"].to_numpy()], "daytype": daytype,
+                              self.key: _scale_key(stacked, self.scale).to_numpy(),
+                              "occ": stacked["occ"].to_numpy(), "flow": stacked["flow"].to_numpy()})
+        moments = _moments(batch, self.keys)
+        if len(self.state) == 0:
+            self.state = moments
+            return self
+        positions = self._state_index().get_indexer(pd.MultiIndex.from_frame(moments[self.keys]))
+        seen = positions >= 0
+        rows = positions[seen]
+        state = self.state
+        for metric in METRICS:
+            names = ["n_" + metric, "mean_" + metric, "m2_" + metric]
+            merged = _merge_moments(*[state[name].to_numpy()[rows] for name in names],
+                                    *[moments[name].to_numpy()[seen] for name in names])
+            for name, values in zip(names, merged):
+                state.iloc[rows, state.columns.get_loc(name)] = values
+        if not seen.all():
+            new = moments[~seen]
+            index = self._state_index().append(pd.MultiIndex.from_frame(new[self.keys]))
+            state = pd.concat([state, new[state.columns]], ignore_index=True)
+            self._index = (state, index)
+        self.state = state
+        return self
+
+    def merge(self, other):
+        """Statistics of the data seen by self and other, e.g. computed by different workers"""
+        return merge_stats([self, other])
+
+    def _select(self, ids=None, daytype=None):
+        """Rows of the state of the sensors ids and of a daytype, all if None"""
+        state = self.state
+        if ids is not None:
+            state = state[state["sensor"].isin(ids).to_numpy()]
+        if daytype is not None:
+            state = state[(state["daytype"] == daytype).to_numpy()]
+        return state
+
+    def query(self, ids=None, daytype=None, with_std=False):
+        """Mean occupancy and flow per bucket over all selected sensors, gives the same statistics
+        as utils.query on all the data seen
+
+        Args:
+        - ids: list of sensor ids to consider, if None, use all sensors
+        - daytype: daytype to consider, if None, use all daytypes
+        - with_std: whether to also return the standard deviations "occ_std" and "flow_std"
+
+        Returns:
+        - pd.DataFrame with columns key (e.g. hour), occ, flow
+        """
+        state = _combine([self._select(ids, daytype)], [self.key])
+        agg_data = pd.DataFrame({self.key: state[self.key].to_numpy()})
+        for metric in METRICS:
+            n = state["n_" + metric].to_numpy(dtype=np.float64)
+            agg_data[metric] = np.where(n > 0, state["mean_" + metric].to_numpy(), np.nan)
+            if with_std:
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    agg_data[metric + "_std"] = np.sqrt(state["m2_" + metric].to_numpy() / (n - 1))
+        return agg_data
+
+    def by_sensor(self, metric="occ", daytype=None, stat="mean", transform=None):
+        """Statistics of every sensor per bucket, e.g. the hourly profile of every sensor
+
+        Args:
+        - metric: {"occ", "flow"}
+        - daytype: daytype to consider, if None, combine all daytypes
+        - stat: {"mean", "std", "count"}
+        - transform: None, "relative" or "normalize", applied to the profile of every sensor (see utils)
+
+        Returns:
+        - pd.DataFrame indexed by sensor id with one column per bucket
+        """
+        state = _combine([self._select(None, daytype)], ["sensor", self.key])
+        n = state["n_" + metric].to_numpy(dtype=np.float64)
+        if stat == "mean":
+            values = np.where(n > 0, state["mean_" + metric].to_numpy(), np.nan)
+        elif stat == "std":
+            with np.errstate(invalid="ignore", divide="ignore"):
+                values = np.sqrt(state["m2_" + metric].to_numpy() / (n - 1))
+        elif stat == "count":
+            values = n
+        else:
+            raise ValueError("Unknown stat " + str(stat) + ", choose from mean, std, count")
+        table = pd.DataFrame({"sensor": state["sensor"], self.key: state[self.key], "value": values})
+        table = table.pivot(index="sensor", columns=self.key, values="value").rename_axis("detid")
+        if transform == "relative":
+            return relative(table, axis=1)
+        elif transform == "normalize":
+            return normalize(table, axis=1)
+        return table
+
+    def zscore(self, data, id, daytype, metric="occ"):
+        """Deviation of new rows of a sensor from its running mean, in standard deviations of its bucket
+
+        Args:
+        - data: dataframe of the new rows of the sensor
+        - id: sensor id
+        - daytype: daytype of the rows
+        - metric: {"occ", "flow"}
+
+        Returns:
+        - numpy array, nan for rows of buckets without statistics
+        """
+        state = self._select([id], daytype).set_index(self.key)
+        keys = _scale_key(data, self.scale).to_numpy()
+        n = state["n_" + metric].reindex(keys).to_numpy(dtype=np.float64)
+        mean = state["mean_" + metric].reindex(keys).to_numpy()
+        with np.errstate(invalid="ignore", divide="ignore"):
+            std = np.sqrt(state["m2_" + metric].reindex(keys).to_numpy() / (n - 1))
+            return (data[metric].to_numpy(dtype=np.float64) - mean) / std
+
+    def save(self, path):
+        """Save the statistics and their scale to a .npz file"""
+        _save_frame(self.state, path, meta={"scale": self.scale})
+
+def merge_stats(stats):
+    """Merge the statistics of disjoint data, e.g. computed by parallel workers
+
+    Args:
+    - stats: list of OnlineStats of the same scale
+
+    Returns:
+    - OnlineStats
+    """
+    scales = set(s.scale for s in stats)
+    if len(scales) != 1:
+        raise ValueError("Cannot merge statistics of different scales " + str(scales))
+    scale = scales.pop()
+    merged = OnlineStats(scale)
+    merged.state = _combine([s.state for s in stats], merged.keys)
+    return merged
+
+def load_stats(path, scale=None):
+    """Load statistics saved by OnlineStats.save
+
+    Args:
+    - path: path to the .npz file
+    - scale: expected scale of the statistics, if None, the scale they were saved with
+
+    Returns:
+    - OnlineStats
+    """
+    saved = _load_meta(path).get("scale", "hour")
+    if scale is not None and scale != saved:
+        raise ValueError("The statistics in " + path + " have scale " + saved + ", not " + str(scale))
+    return OnlineStats(saved, _load_frame(path))
+
+# Testing
+if __name__ == "__main__":
+    from datetime import datetime
+    from utils import read_from_ids, time_range
+    id_path = "./preprocessed_data/city/city_id.csv"
+    data_path = "./preprocessed_data/city"
+    id = list(pd.read_csv(id_path)["detid"])
+    weekend_df_dict = read_from_ids(id, "weekend", data_path)
+    stats = OnlineStats("hour")
+    for month in range(1, 13):
+        batch = {i: time_range(data, datetime(2018, month, 1), datetime(2018 + month // 12, month % 12 + 1, 1)) for i, data in weekend_df_dict.items()}
+        stats.update(batch, "weekend")
+    print(stats.query(with_std=True))
+    print(stats.by_sensor("occ", transform="normalize").head())
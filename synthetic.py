@@ -0,0 +1,273 @@
+import pandas as pd
+import numpy as np
+import os
+
+"""
+Deterministic generator of synthetic data sets in the raw formats described in README.md, for
+benchmarking and testing the utilities without access to the private data.
+
+Traffic follows a daily profile with morning and evening peaks on workdays and a single midday
+peak on weekends, scaled per detector and perturbed by noise.
+"""
+
+# Sizes of the generated data sets, see make_dataset
+PRESETS = {
+    "small": dict(city_detectors=5, city_years=[2018], canton_sites=2, canton_days=2, astra_detectors=2,
+                  astra_months=["2021-01", "2021-03"], vehicles_per_day=2000, districts=4),
+    "medium": dict(city_detectors=50, city_years=[2018, 2019], canton_sites=10, canton_days=14, astra_detectors=10,
+                   astra_months=["2021-02", "2021-03"], vehicles_per_day=20000, districts=12),
+    "large": dict(city_detectors=500, city_years=[2018, 2019, 2020], canton_sites=50, canton_days=60, astra_detectors=100,
+                  astra_months=["2021-01", "2021-02", "2021-03"], vehicles_per_day=100000, districts=12),
+}
+
+# Bounding box of the generated detectors, around Zurich
+LAT_RANGE = (47.32, 47.43)
+LON_RANGE = (8.45, 8.62)
+
+def daily_profile(seconds, weekend):
+    """Relative traffic intensity at seconds from midnight, peaking around 1
+
+    Args:
+    - seconds: numpy array of seconds from midnight
+    - weekend: numpy array of bool, whether the day is a weekend day
+
+    Returns:
+    - numpy array of intensities
+    """
+    hour = seconds / 3600
+    workday = 0.15 + 0.85 * np.exp(-((hour - 7.5) / 1.5) ** 2) + 0.8 * np.exp(-((hour - 17.5) / 2) ** 2) + 0.4 * np.exp(-((hour - 12.5) / 3) ** 2)
+    weekend_day = 0.1 + 0.7 * np.exp(-((hour - 14) / 4) ** 2)
+    return np.where(weekend, weekend_day, workday)
+
+def _vehicle_times(rng, day_seconds, n):
+    """Sorted arrival times in seconds from midnight of n vehicles, following the daily profile"""
+    grid = np.arange(0, day_seconds, 60)
+    weights = daily_profile(grid, np.zeros(len(grid), dtype=bool))
+    minutes = rng.choice(len(grid), size=n, p=weights / weights.sum())
+    return np.sort(grid[minutes] + rng.random(n) * 60)
+
+def _vehicles(rng, n):
+    """Class, length (cm) and speed (km/h) of n vehicles"""
+    vehicle_class = rng.choice(np.arange(1, 11), size=n, p=[0.01, 0.02, 0.75, 0.03, 0.08, 0.02, 0.01, 0.04, 0.02, 0.02])
+    base_length = np.array([1200, 220, 450, 900, 600, 1000, 1400, 1000, 1600, 1800])[vehicle_class - 1]
+    length = (base_length * (0.9 + 0.2 * rng.random(n))).astype(np.int64)
+    speed = np.clip(rng.normal(80, 12, n), 5, 180).astype(np.int64)
+    return vehicle_class, length, speed
+
+def make_city(out_dir, n_detectors, years, interval=180, seed=0):
+    """Write city yearly files Zurich_YYYY_raw2.csv, generated and appended one day at a time
+
+    Args:
+    - out_dir: output directory
+    - n_detectors: number of detectors
+    - years: list of years
+    - interval: length of a measurement interval in seconds
+    - seed: random seed
+
+    Returns:
+    - list of detector ids
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    detids = ["K" + str(i // 4 + 1) + ".D" + str(i % 4 + 11) for i in range(n_detectors)]
+    capacity = rng.uniform(300, 1500, n_detectors)
+    intervals = np.arange(interval - 1, 86400, interval)
+    detector = np.tile(np.arange(n_detectors), len(intervals))
+    seconds = np.repeat(intervals, n_detectors)
+    n = len(seconds)
+    for year in years:
+        # One day at a time, such that memory does not grow with the number of days
+        path = os.path.join(out_dir, "Zurich_" + str(year) + "_raw2.csv")
+        for i, day in enumerate(pd.date_range(str(year) + "-01-01", str(year) + "-12-31", freq="D")):
+            intensity = daily_profile(seconds, np.full(n, day.dayofweek >= 5))
+            flow = np.maximum(capacity[detector] * intensity * rng.normal(1, 0.15, n), 0)
+            occ = np.clip(flow / capacity[detector] * 15 * rng.normal(1, 0.1, n), 0, 100)
+            valid = (rng.random(n) > 0.02).astype(np.int64)
+            suspect = (rng.random(n) < 0.01).astype(np.int64)
+            missing = rng.random(n) < 0.005
+            flow[missing] = np.nan
+            occ[missing] = np.nan
+            pd.DataFrame({
+                "day": day.strftime("%Y-%m-%d"),
+                "interval": seconds,
+                "detid": np.array(detids)[detector],
+                "flow": flow,
+                "occ": occ,
+                "valid": valid,
+                "suspect": suspect,
+            }).to_csv(path, mode="w" if i == 0 else "a", header=i == 0, index=False, float_format="%.6f")
+    return detids
+
+VBV_HEADER = """* BEGIN
+* FORMAT = VBV-1
+* FORMATTER = GRFORMAT Release = 3.5.47
+* INSTRUMENT = M680 Serial = 705172 Release = 2.9
+* FILENAME =
+* SITE = {site}
+* LOCATION = Synthetic
+* GRIDREF =
+* HEADINGS =
+* STARTREC = 00:00 {start}
+* STOPREC  = 00:00 {stop}
+* BATTERY = 6.90 6.90
+* SENSORS = LL LL NONE NONE NONE NONE NONE NONE
+* DATEFORM = DD/MM/YY
+* UNITS = Metric
+* PRUNITS = KPH-CM-10KG
+* CLASS = SWISS10
+* SITE    HEAD   DDMMYY HHMM SS HH RESCOD  L D HEAD  GAP SPD LENTH    CS CH
+"""
+
+def make_canton(out_dir, n_sites, days, vehicles_per_day, seed=0):
+    """Write canton VBV-1 files named by site and date, e.g. 1888210929
+
+    Args:
+    - out_dir: output directory
+    - n_sites: number of sites, each with two lanes
+    - days: list of dates
+    - vehicles_per_day: mean number of vehicles per site and day
+    - seed: random seed
+
+    Returns:
+    - list of detector ids
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    sites = 1000 + np.arange(n_sites) * 7
+    for site in sites:
+        for day in pd.DatetimeIndex(days):
+            n = rng.poisson(vehicles_per_day)
+            times = _vehicle_times(rng, 86400, n)
+            vehicle_class, length, speed = _vehicles(rng, n)
+            lane = rng.integers(1, 3, n)
+            headway = np.minimum(np.diff(times, prepend=0.0), 99.9)
+            gap = np.maximum(headway - length / 100 / (speed / 3.6), 0)
+            centiseconds = np.floor(times * 100).astype(np.int64)
+            rows = np.empty((n, 14), dtype=object)
+            rows[:, 0] = site
+            rows[:, 1] = np.arange(1, n + 1)
+            rows[:, 2] = day.strftime("%d%m%y")
+            rows[:, 3] = centiseconds // 360000 * 100 + centiseconds // 6000 % 60
+            rows[:, 4] = centiseconds // 100 % 60
+            rows[:, 5] = centiseconds % 100
+            rows[:, 6] = lane
+            rows[:, 7] = 1
+            rows[:, 8] = headway
+            rows[:, 9] = gap
+            rows[:, 10] = speed
+            rows[:, 11] = length
+            rows[:, 12] = vehicle_class
+            rows[:, 13] = np.where(length > 800, "H", "L")
+            path = os.path.join(out_dir, str(site) + day.strftime("%y%m%d"))
+            with open(path, "w") as f:
+                f.write(VBV_HEADER.format(site=site, start=day.strftime("%d/%m/%y"), stop=(day + pd.Timedelta(days=1)).strftime("%d/%m/%y")))
+                np.savetxt(f, rows, fmt="%8d  %06d %s %04d %02d %02d 000000 %2d %d %4.1f %4.1f %3d %5d    %2d  %s")
+    return ["canton_" + str(site) + "_" + str(lane) for site in sites for lane in [1, 2]]
+
+ASTRA_COLUMNS = ["_id", "_class", "src_time", "src_time_src", "src_time_inc", "rcv_delay", "prot_type", "zs_id", "vd",
+                 "vd_seqnum_type", "vd_seqnum_val", "vd_status", "vd_class_type", "vd_class_val", "vd_length_type",
+                 "vd_length_val", "vd_dir", "vd_speed_type", "vd_speed_val", "vd_occ_type", "vd_occ_val",
+                 "vd_head_type", "vd_head_val", "vd_gap_type", "vd_gap_val"]
+
+def _local_time(timestamp):
+    """Format time zone aware times as ISO 8601 with their UTC offset, e.g. 2021-03-28T03:10:00.000000+02:00"""
+    text = pd.Series(timestamp.strftime("%Y-%m-%dT%H:%M:%S.%f%z"))
+    return (text.str[:-2] + ":" + text.str[-2:]).to_numpy()
+
+def make_astra(out_dir, n_detectors, months, vehicles_per_day, seed=0):
+    """Write astra monthly files named by sensor and month, e.g. 20_2021-01.csv. Event times are
+    local Zurich times with their UTC offset, which changes within the months of a daylight saving
+    time switch (March, October)
+
+    Args:
+    - out_dir: output directory
+    - n_detectors: number of sensors, each with two lanes
+    - months: list of "YYYY-MM"
+    - vehicles_per_day: mean number of vehicles per sensor and day
+    - seed: random seed
+
+    Returns:
+    - list of detector ids
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    zs_ids = 2 + np.arange(n_detectors)
+    for zs_id in zs_ids:
+        for month in months:
+            start = pd.Timestamp(month + "-01")
+            n_days = start.days_in_month
+            n = rng.poisson(vehicles_per_day * n_days)
+            times = np.sort(_vehicle_times(rng, 86400, n) + rng.integers(0, n_days, n) * 86400)
+            vehicle_class, length, speed = _vehicles(rng, n)
+            headway = np.diff(times, prepend=0.0)
+            data = pd.DataFrame({
+                "_id": np.char.add("ev", np.arange(n).astype(str)),
+                "_class": "VehicleDetection",
+                "src_time": _local_time((start + pd.to_timedelta(times, unit="s")).tz_localize(
+                    "Europe/Zurich", ambiguous=np.ones(n, dtype=bool), nonexistent="shift_forward")),
+                "src_time_src": 1, "src_time_inc": 0, "rcv_delay": rng.integers(0, 500, n), "prot_type": 2,
+                "zs_id": zs_id, "vd": rng.integers(1, 3, n), "vd_seqnum_type": 0, "vd_seqnum_val": np.arange(n),
+                "vd_status": 0, "vd_class_type": 0, "vd_class_val": vehicle_class, "vd_length_type": 0,
+                "vd_length_val": length, "vd_dir": "normal", "vd_speed_type": 0, "vd_speed_val": speed,
+                "vd_occ_type": 0, "vd_occ_val": (length / 100 / (speed / 3.6) * 1000).astype(np.int64),
+                "vd_head_type": 0, "vd_head_val": (headway * 1000).astype(np.int64), "vd_gap_type": 0,
+                "vd_gap_val": np.maximum(headway * 1000 - length / 100 / (speed / 3.6) * 1000, 0).astype(np.int64),
+            })
+            data[ASTRA_COLUMNS].to_csv(os.path.join(out_dir, str(zs_id) + "_" + month + ".csv"), index=False)
+    return ["astra_" + str(zs_id) + "_" + str(lane) for zs_id in zs_ids for lane in [1, 2]]
+
+def make_gis(out_dir, city_ids, canton_ids, astra_ids, n_districts, seed=0):
+    """Write GIS layers of the detector points (loop_update_city, canton, astra) and of square
+    districts (districts, with an "id" column) as GeoJSON files
+
+    Args:
+    - out_dir: output directory
+    - city_ids, canton_ids, astra_ids: lists of detector ids
+    - n_districts: number of districts along each axis of the bounding box
+    - seed: random seed
+    """
+    import geopandas as gpd
+    import shapely
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    for name, ids in [("loop_update_city", city_ids), ("canton", canton_ids), ("astra", astra_ids)]:
+        lat = rng.uniform(*LAT_RANGE, len(ids))
+        lon = rng.uniform(*LON_RANGE, len(ids))
+        columns = {"detid": ids}
+        if name == "loop_update_city":
+            columns["type"] = "IMP"
+        gdf = gpd.GeoDataFrame(columns, geometry=gpd.points_from_xy(lon, lat), crs="EPSG:4326")
+        gdf.to_file(os.path.join(out_dir, name + ".geojson"), driver="GeoJSON")
+
+    lat = np.linspace(*LAT_RANGE, n_districts + 1)
+    lon = np.linspace(*LON_RANGE, n_districts + 1)
+    boxes = [shapely.box(lon[i], lat[j], lon[i + 1], lat[j + 1]) for i in range(n_districts) for j in range(n_districts)]
+    districts = gpd.GeoDataFrame({"id": np.arange(len(boxes)), "Kreis": ["Kreis_" + str(i) for i in range(len(boxes))]},
+                                 geometry=boxes, crs="EPSG:4326")
+    districts.to_file(os.path.join(out_dir, "districts.geojson"), driver="GeoJSON")
+
+def make_dataset(root, preset="small", seed=0, **sizes):
+    """Write a whole synthetic data set:
+    root/raw_data/{city, canton, astra}/ and root/spatial/*.geojson
+
+    Args:
+    - root: output directory
+    - preset: {"small", "medium", "large"}, see PRESETS
+    - seed: random seed
+    - sizes: overrides of the preset, e.g. city_detectors=100
+
+    Returns:
+    - A dict with keys being "city", "canton" and "astra" and value being the detector ids
+    """
+    config = dict(PRESETS[preset], **sizes)
+    raw = os.path.join(root, "raw_data")
+    city_ids = make_city(os.path.join(raw, "city"), config["city_detectors"], config["city_years"], seed=seed)
+    canton_days = pd.date_range("2021-09-27", periods=config["canton_days"], freq="D")
+    canton_ids = make_canton(os.path.join(raw, "canton"), config["canton_sites"], canton_days, config["vehicles_per_day"], seed=seed + 1)
+    astra_ids = make_astra(os.path.join(raw, "astra"), config["astra_detectors"], config["astra_months"], config["vehicles_per_day"], seed=seed + 2)
+    make_gis(os.path.join(root, "spatial"), city_ids, canton_ids, astra_ids, config["districts"], seed=seed + 3)
+    return {"city": city_ids, "canton": canton_ids, "astra": astra_ids}
+
+# Testing
+if __name__ == "__main__":
+    print(make_dataset("./synthetic_data", "small"))
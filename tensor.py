@@ -0,0 +1,177 @@
+import pandas as pd
+import numpy as np
+import os
+import json
+from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
+from utils import _read_sensor
+
+"""
+Dense sensor x time x metric representation of the network, stored as memory-mapped
+numpy arrays such that whole-network analysis does not need one dataframe per sensor.
+
+A tensor store is a directory containing:
+- values.npy: float32 array of shape (sensor, hour, metric), NaN where there is no data
+- sensors.npy: sensor ids
+- times.npy: start of every hourly time bucket, covering whole days
+- daytypes.npy: daytype of every time bucket, "" where no sensor has data
+- meta.json: metric names
+"""
+
+class SensorTensor:
+    """A memory-mapped tensor store opened by open_tensor. Slicing the time axis or a metric
+    returns views on the file, nothing is read until the values are used.
+    """
+    def __init__(self, values, sensors, times, daytypes, metrics):
+        self.values = values
+        self.sensors = pd.Index(sensors)
+        self.times = times
+        self.daytypes = daytypes
+        self.metrics = list(metrics)
+
+    def sensor_index(self, ids):
+        """Positions of sensor ids on the sensor axis, -1 for unknown ids"""
+        return self.sensors.get_indexer(ids)
+
+    def time_slice(self, begin, end):
+        """Slice of the time axis covering [begin, end), found by binary search"""
+        lo = np.searchsorted(self.times, np.datetime64(begin), side="left")
+        hi = np.searchsorted(self.times, np.datetime64(end), side="left")
+        return slice(lo, hi)
+
+    def select(self, begin=None, end=None, metric=None, ids=None):
+        """Select a block of the tensor
+
+        Args:
+        - begin, end: datetime, time range [begin, end), if None, the whole time axis
+        - metric: metric name, if None, keep the metric axis
+        - ids: list of sensor ids, if None, use all sensors. Selecting sensors copies the data,
+          the other selections are views
+
+        Returns:
+        - numpy array of shape (sensor, time[, metric])
+        """
+        times = self.time_slice(begin if begin is not None else self.times[0],
+                                end if end is not None else self.times[-1] + np.timedelta64(1, "h"))
+        block = self.values[:, times]
+        if metric is not None:
+            block = block[:, :, self.metrics.index(metric)]
+        if ids is not None:
+            index = self.sensor_index(ids)
+            if (index < 0).any():
+                raise KeyError("Unknown sensors " + str([id for id, i in zip(ids, index) if i < 0]))
+            block = block[index]
+        return block
+
+    def hourly_profile(self, begin, end, metric, daytype=None):
+        """Mean value of every sensor per hour of the day in [begin, end)
+
+        Args:
+        - begin, end: datetime, whole days
+        - metric: metric name
+        - daytype: if given, only use days of this daytype
+
+        Returns:
+        - numpy array of shape (sensor, 24)
+        """
+        times = self.time_slice(begin, end)
+        hours = self.times[times]
+        if len(hours) == 0 or len(hours) % 24 != 0 or (hours[0] - hours[0].astype("datetime64[D]")) != np.timedelta64(0, "h"):
+            raise ValueError("hourly_profile needs whole days, [" + str(begin) + ", " + str(end) + ") covers "
+                             + str(len(hours)) + " hours of the tensor" + ("" if len(hours) == 0 else " from " + str(hours[0])))
+        block = self.select(begin, end, metric).reshape(len(self.sensors), -1, 24)
+        if daytype is not None:
+            block = block[:, self.daytypes[times][::24] == daytype]
+        with np.errstate(invalid="ignore"):
+            return np.nanmean(block, axis=1)
+
+def open_tensor(path):
+    """Open a tensor store written by build_tensor, values are memory-mapped read-only
+
+    Args:
+    - path: directory of the tensor store
+
+    Returns:
+    - SensorTensor
+    """
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    return SensorTensor(
+        np.load(os.path.join(path, "values.npy"), mmap_mode="r"),
+        np.load(os.path.join(path, "sensors.npy")),
+        np.load(os.path.join(path, "times.npy")),
+        np.load(os.path.join(path, "daytypes.npy")),
+        meta["metrics"]
+    )
+
+def _hour_buckets(sensor_data, start, n_times):
+    """Index of the hourly time bucket of every row, -1 for rows outside the time axis"""
+    hours = (sensor_data["date"].to_numpy().astype("datetime64[h]") - start).astype(np.int64) + sensor_data["hour"].to_numpy()
+    return np.where((hours >= 0) & (hours < n_times), hours, -1)
+
+def build_tensor(ids, daytypes, dir, path, begin, end, metrics=("flow", "occ"), n_workers=None):
+    """Build a tensor store from per-sensor files. Sensors are read one at a time per thread and
+    written into the memory-mapped array, the rows falling in the same hour are averaged.
+
+    Args:
+    - ids: list of sensor ids
+    - daytypes: list of daytypes to read, e.g. ["workday", "weekend", "holiday"] for the whole timeline
+    - dir: directory containing files, as for read_from_ids
+    - path: directory of the tensor store
+    - begin, end: datetime, time range of the tensor, rounded to whole days
+    - metrics: columns to store
+    - n_workers: number of threads, if None, use the default of ThreadPoolExecutor, min(32, number of cpus + 4)
+
+    Returns:
+    - SensorTensor opened on the new store
+    """
+    start = np.datetime64(pd.Timestamp(begin).normalize(), "h")
+    stop = np.datetime64(pd.Timestamp(end).ceil("D"), "h")
+    times = np.arange(start, stop, np.timedelta64(1, "h"))
+    os.makedirs(path, exist_ok=True)
+    values = np.lib.format.open_memmap(os.path.join(path, "values.npy"), mode="w+", dtype=np.float32,
+                                       shape=(len(ids), len(times), len(metrics)))
+    values[:] = np.nan
+    daytype_of_time = np.full(len(times), "", dtype="U7")
+
+    def write_sensor(i):
+        for daytype in daytypes:
+            try:
+                sensor_data = _read_sensor(ids[i], daytype, dir, use_cache=True)
+            except FileNotFoundError:
+                continue
+            buckets = _hour_buckets(sensor_data, start, len(times))
+            inside = buckets >= 0
+            buckets = buckets[inside]
+            daytype_of_time[buckets] = daytype
+            for j, metric in enumerate(metrics):
+                metric_values = sensor_data[metric].to_numpy(dtype=np.float64)[inside]
+                valid = ~np.isnan(metric_values)
+                sums = np.bincount(buckets[valid], weights=metric_values[valid], minlength=len(times))
+                counts = np.bincount(buckets[valid], minlength=len(times))
+                filled = counts > 0
+                values[i, filled, j] = sums[filled] / counts[filled]
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        list(tqdm(executor.map(write_sensor, range(len(ids))), total=len(ids), desc="Building tensor"))
+    values.flush()
+    del values
+
+    np.save(os.path.join(path, "sensors.npy"), np.array(ids, dtype=str))
+    np.save(os.path.join(path, "times.npy"), times.astype("datetime64[ns]"))
+    np.save(os.path.join(path, "daytypes.npy"), daytype_of_time)
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump({"metrics": list(metrics)}, f)
+    return open_tensor(path)
+
+# Testing
+if __name__ == "__main__":
+    from datetime import datetime
+    id_path = "./preprocessed_data/city/city_id.csv"
+    data_path = "./preprocessed_data/city"
+    tensor_path = "./preprocessed_data/city_tensor"
+    id = list(pd.read_csv(id_path)["detid"])
+    build_tensor(id, ["workday", "weekend", "holiday"], data_path, tensor_path, datetime(2018,1,1), datetime(2021,1,1))
+    tensor = open_tensor(tensor_path)
+    print(tensor.values.shape)
+    print(np.nanmean(tensor.hourly_profile(datetime(2018,1,1), datetime(2019,1,1), "occ", "weekend"), axis=0))
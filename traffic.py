@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+"""
+Command line entry point: python traffic.py {ingest, convert, watch, query, plot} ...
+
+Heavy dependencies are only imported by the subcommand that needs them, such that e.g.
+a query does not pay for plotly and geopandas.
+"""
+import argparse
+import os
+import sys
+import time
+
+def run_ingest(args):
+    """Ingest raw canton, astra or city files"""
+    if args.source == "canton":
+        from ingest import ingest_canton_files
+        rows = ingest_canton_files(args.paths, args.out, args.workers)
+    elif args.source == "astra":
+        from ingest import ingest_astra_files
+        rows = ingest_astra_files(args.paths, args.out, args.workers)
+    else:
+        from ingest import split_city_files
+        rows = split_city_files(args.paths, args.out, args.workers)
+    for key, n in rows.items():
+        print(key, n, sep="\t")
+
+def run_convert(args):
+    """Convert ingested canton or astra vehicles into intervals of flow and occupancy"""
+    from ingest import convert_vehicle_dirs
+    rows = convert_vehicle_dirs(args.dir, args.out, args.source, args.interval, n_workers=args.workers)
+    for daytype, n in rows.items():
+        print(daytype, n, sep="\t")
+
+def run_watch(args):
+    """Ingest new and changed raw files, once or periodically"""
+    from watcher import sync, watch
+    if args.once:
+        for path, result in sync(args.raw, args.out, args.workers, args.interval).items():
+            print(path, result, sep="\t")
+    else:
+        watch(args.raw, args.out, args.period, args.workers, args.interval)
+
+def run_query(args):
+    """Query aggregated statistics of a set of sensors and print them as csv"""
+    import pandas as pd
+    from utils import read_from_ids, query, query_by_sensor
+
+    ids = list(args.id)
+    if args.ids is not None:
+        ids += list(pd.read_csv(args.ids)["detid"])
+    data_dict, failed = read_from_ids(ids, args.daytype, args.dir, return_failed=True, quality=args.quality)
+    for id, reason in failed.items():
+        print("Could not read " + id + ": " + reason, file=sys.stderr)
+    if len(data_dict) == 0:
+        sys.exit("No sensor could be read")
+    if args.quality is not None:
+        from utils import quality_report
+        dropped = quality_report(data_dict)["dropped_at_load"]
+        print("Dropped " + str(dropped.sum()) + " rows failing the " + args.quality + " policy in " + str((dropped > 0).sum()) + " sensors", file=sys.stderr)
+
+    begin, end = pd.Timestamp(args.begin), pd.Timestamp(args.end)
+    if args.by_sensor:
+        result = query_by_sensor(data_dict, begin, end, args.scale, args.metric).reset_index()
+    else:
+        result = query(list(data_dict.values()), begin, end, args.scale)
+    result.to_csv(sys.stdout, index=False)
+
+def run_plot(args):
+    """Draw the figures described in a json file, see export.export_figures"""
+    import json
+    from export import export_figures
+
+    with open(args.spec) as f:
+        specs = json.load(f)
+    status = export_figures(specs, args.out, args.workers, args.image, args.force)
+    for name, result in status.items():
+        print(name, result, sep="\t")
+    if any(result not in ("written", "skipped") for result in status.values()):
+        sys.exit(1)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="traffic", description="Traffic sensor data utilities")
+    parser.add_argument("--profile", default=None, metavar="PATH", help="record timing spans to a JSON lines file and print a summary")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    ingest = subparsers.add_parser("ingest", help="ingest raw data files")
+    ingest.add_argument("source", choices=["canton", "astra", "city"])
+    ingest.add_argument("paths", nargs="+", help="raw files, e.g. canton 1888210929, astra 20_2021-01.csv, city Zurich_2018_raw2.csv")
+    ingest.add_argument("--out", required=True, help="output directory")
+    ingest.add_argument("--workers", type=int, default=None, help="number of processes")
+    ingest.set_defaults(run=run_ingest)
+
+    convert = subparsers.add_parser("convert", help="convert ingested vehicles into intervals of flow and occupancy")
+    convert.add_argument("source", choices=["canton", "astra"])
+    convert.add_argument("dir", help="output directory of the ingest of this source")
+    convert.add_argument("--out", required=True, help="output directory, readable by query")
+    convert.add_argument("--interval", type=int, default=180, help="length of the intervals in seconds")
+    convert.add_argument("--workers", type=int, default=None, help="number of processes")
+    convert.set_defaults(run=run_convert)
+
+    watch = subparsers.add_parser("watch", help="ingest new and changed raw files of all sources")
+    watch.add_argument("raw", help="directory containing the raw files, searched recursively")
+    watch.add_argument("--out", required=True, help="output directory")
+    watch.add_argument("--once", action="store_true", help="process the new files once instead of watching")
+    watch.add_argument("--period", type=int, default=60, help="seconds between two passes")
+    watch.add_argument("--interval", type=int, default=180, help="length of the intervals vehicles are converted into, in seconds")
+    watch.add_argument("--workers", type=int, default=None, help="number of processes")
+    watch.set_defaults(run=run_watch)
+
+    query = subparsers.add_parser("query", help="print aggregated statistics as csv")
+    query.add_argument("--dir", required=True, help="directory containing the per-sensor files")
+    query.add_argument("--daytype", required=True, choices=["workday", "weekend", "holiday"])
+    query.add_argument("--ids", default=None, help="csv file with a detid column")
+    query.add_argument("--id", action="append", default=[], help="sensor id, can be repeated")
+    query.add_argument("--begin", required=True, help="e.g. 2018-01-01")
+    query.add_argument("--end", required=True, help="e.g. 2019-01-01")
+    query.add_argument("--scale", default="hour", choices=["hour", "day", "week", "month"])
+    query.add_argument("--by-sensor", action="store_true", help="one row per sensor instead of all sensors together")
+    query.add_argument("--metric", default="occ", choices=["occ", "flow"], help="metric of --by-sensor")
+    query.add_argument("--quality", default=None, choices=["valid", "strict"], help="skip rows not flagged valid (and, if strict, flagged suspect)")
+    query.set_defaults(run=run_query)
+
+    plot = subparsers.add_parser("plot", help="draw figures described in a json file")
+    plot.add_argument("spec", help='json list of {"name": ..., "builder": "draw_...", "args": [...], "kwargs": {...}}')
+    plot.add_argument("--out", required=True, help="output directory")
+    plot.add_argument("--workers", type=int, default=None, help="number of processes")
+    plot.add_argument("--image", default=None, help="also write static images of this format, e.g. png")
+    plot.add_argument("--force", action="store_true", help="redraw unchanged figures")
+    plot.set_defaults(run=run_plot)
+
+    args = parser.parse_args(argv)
+    if args.profile is not None:
+        import profiling
+        # Workers append their spans to the same file, spawned ones enable profiling from the environment
+        os.environ["TRAFFIC_PROFILE"] = os.path.abspath(args.profile)
+        profiling.enable(args.profile)
+        started = time.time()
+        args.run(args)
+        spans = profiling.read_records(args.profile) if os.path.exists(args.profile) else []
+        spans = [record for record in spans if record["start"] >= started]
+        print(profiling.summary(spans).to_string(), file=sys.stderr)
+    else:
+        args.run(args)
+
+if __name__ == "__main__":
+    main()
@@ -1,118 +1,530 @@
 import pandas as pd
 import os
+import warnings
 from tqdm import tqdm
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import numpy as np
+from profiling import span, add_rows
 
-def read_from_ids(ids, daytype, dir):
+CACHE_DIR = ".cache"
+
+# Quality policies on the flags of the city data, a policy maps flag columns to the value they must have
+QUALITY_POLICIES = {"valid": {"valid": 1}, "strict": {"valid": 1, "suspect": 0}}
+
+def _quality_mask(columns, quality):
+    """Rows passing a quality policy
+
+    Args:
+    - columns: dataframe or opened .npz file holding the flag columns
+    - quality: name of a policy of QUALITY_POLICIES, or a dict mapping flag columns to their
+      required value. Flag columns that are not in columns are not checked
+
+    Returns:
+    - boolean numpy array, or None if no row is filtered by the policy
+    """
+    if quality is None:
+        return None
+    if isinstance(quality, str):
+        if quality not in QUALITY_POLICIES:
+            raise ValueError("Unknown quality policy " + quality + ", choose from " + str(list(QUALITY_POLICIES)))
+        quality = QUALITY_POLICIES[quality]
+    mask = None
+    for name, value in quality.items():
+        if name in columns:
+            passing = np.asarray(columns[name]) == value
+            mask = passing if mask is None else mask & passing
+    return mask
+
+def _source_stat(path):
+    """Modification time (in ns) and size of a file, as stored with the cache parsed from it"""
+    stat = os.stat(path)
+    return np.array([stat.st_mtime_ns, stat.st_size], dtype=np.int64)
+
+def _save_frame(df, path, source=None, meta=None):
+    """Save a dataframe as a columnar .npz file. Datetime columns keep their dtype,
+    object columns are stored as fixed-width strings along with a mask of their missing values.
+    The file is written to a temporary path first and then moved, such that readers never see
+    half a file.
+
+    Args:
+    - df: pandas dataframe
+    - path: destination path, should end with ".npz"
+    - source: if given, path of the file df was parsed from, whose modification time and size
+      are stored in the file (see _is_fresh)
+    - meta: dict of strings stored in the file, read back by _load_meta
+    """
+    columns = {}
+    extra = {}
+    for name in df.columns:
+        values = df[name].to_numpy()
+        if values.dtype == object:
+            missing = pd.isna(values)
+            if missing.any():
+                extra["__missing__" + str(name)] = missing
+            values = values.astype(str)
+        columns[str(name)] = values
+    if source is not None:
+        extra["__source__"] = _source_stat(source)
+    if meta is not None:
+        extra["__meta__"] = np.array([[str(key), str(value)] for key, value in meta.items()], dtype=str).reshape(-1, 2)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, __columns__=np.array(list(columns.keys())), **columns, **extra)
+    os.replace(tmp_path, path)
+
+def _is_fresh(path, source):
+    """Whether a .npz file saved with _save_frame(..., source=source) still matches its source,
+    i.e. the source has the same modification time and size as when the file was written
+    """
+    if not os.path.exists(path):
+        return False
+    with np.load(path, allow_pickle=False) as f:
+        if "__source__" not in f.files:
+            return False
+        return np.array_equal(f["__source__"], _source_stat(source))
+
+def _load_meta(path):
+    """Dict of strings stored with a frame by _save_frame, empty if none was stored"""
+    with np.load(path, allow_pickle=False) as f:
+        if "__meta__" not in f.files:
+            return {}
+        return {str(key): str(value) for key, value in f["__meta__"]}
+
+def _column(f, name, mask=None):
+    """Column of an opened .npz file saved by _save_frame, with its missing values restored"""
+    values = f[name] if mask is None else f[name][mask]
+    if "__missing__" + name in f.files:
+        missing = f["__missing__" + name] if mask is None else f["__missing__" + name][mask]
+        values = values.astype(object)
+        values[missing] = np.nan
+    return values
+
+def _load_frame(path, quality=None):
+    """Load a dataframe saved by _save_frame
+
+    Args:
+    - path: path to the .npz file
+    - quality: quality policy, see _quality_mask. The flag columns are read first and the other
+      columns only keep the passing rows, the number of dropped rows is kept in attrs["dropped"]
+
+    Returns:
+    - pandas dataframe
+    """
+    with np.load(path, allow_pickle=False) as f:
+        mask = _quality_mask(f, quality)
+        frame = pd.DataFrame({name: _column(f, name, mask) for name in f["__columns__"]})
+    if mask is not None:
+        frame.attrs["dropped"] = int(len(mask) - np.count_nonzero(mask))
+    return frame
+
+def _load_parts(part_dir, quality=None):
+    """Load and concatenate the .npz part files of a partitioned dataframe, in order of file name
+
+    Args:
+    - part_dir: directory containing the part files
+    - quality: quality policy, see _load_frame
+
+    Returns:
+    - pandas dataframe
+    """
+    names = sorted(name for name in os.listdir(part_dir) if name.endswith(".npz"))
+    if len(names) == 0:
+        raise FileNotFoundError("No part files in " + part_dir)
+    parts = [_load_frame(os.path.join(part_dir, name), quality) for name in names]
+    frame = pd.concat(parts, ignore_index=True)
+    if quality is not None:
+        frame.attrs["dropped"] = sum(part.attrs.get("dropped", 0) for part in parts)
+    return frame
+
+def _index_by_date(sensor_data):
+    """Sort sensor data by date (stable, so the order within a day is kept) and index it by a
+    DatetimeIndex of the dates, such that time ranges can be found by binary search
+    """
+    if not sensor_data["date"].is_monotonic_increasing:
+        sensor_data = sensor_data.sort_values("date", kind="stable")
+    sensor_data.index = pd.DatetimeIndex(sensor_data["date"].to_numpy())
+    return sensor_data
+
+def time_range(data, begin, end):
+    """Rows of sensor data in [begin, end). Data read by read_from_ids is sorted and indexed by
+    date, the range is then found by binary search and returned as a view without scanning the
+    whole history. Other dataframes fall back to a boolean mask.
+
+    Args:
+    - data: sensor dataframe
+    - begin, end: datetime
+
+    Returns:
+    - dataframe of the rows in range
+    """
+    if isinstance(data.index, pd.DatetimeIndex) and data.index.is_monotonic_increasing:
+        lo = data.index.searchsorted(begin, side="left")
+        hi = data.index.searchsorted(end, side="left")
+        return data.iloc[lo:hi]
+    return data[((data["date"] >= begin) & (data["date"] < end)).to_numpy()]
+
+def _source_mtime(path):
+    """Modification time of a sensor source, the latest part file for a partition directory"""
+    if os.path.isdir(path):
+        return max((entry.stat().st_mtime for entry in os.scandir(path) if entry.name.endswith(".npz")), default=0.0)
+    return os.path.getmtime(path)
+
+@span("read_sensor")
+def _read_sensor(id, daytype, dir, use_cache, quality=None):
+    """Read the data of a single sensor. The csv file is parsed once and stored in
+    dir/daytype/.cache/id.npz; the cache is used as long as the csv has the modification time
+    and size it had when the cache was written.
+    Sensors split by ingest.split_city_year are stored as part files in dir/daytype/id/.
+    The source file and its modification time are kept in the attrs of the dataframe, as
+    well as the quality policy and the number of rows it dropped.
+    """
+    part_dir = os.path.join(dir, daytype, id)
+    if os.path.isdir(part_dir):
+        source = part_dir
+        with span("load_parts"):
+            sensor_data = _load_parts(part_dir, quality)
+    else:
+        source = os.path.join(dir, daytype, id + ".csv")
+        cache_path = os.path.join(dir, daytype, CACHE_DIR, id + ".npz")
+        if use_cache and _is_fresh(cache_path, source):
+            with span("load_cache"):
+                sensor_data = _load_frame(cache_path, quality)
+        else:
+            with span("parse_csv"):
+                sensor_data = pd.read_csv(source)
+                sensor_data["date"] = pd.to_datetime(sensor_data["date"], infer_datetime_format=True)
+            if use_cache:
+                with span("write_cache"):
+                    _save_frame(sensor_data, cache_path, source)
+            # The cache keeps every row, such that other policies can be applied later
+            mask = _quality_mask(sensor_data, quality)
+            if mask is not None:
+                sensor_data = sensor_data[mask].reset_index(drop=True)
+                sensor_data.attrs["dropped"] = int(len(mask) - np.count_nonzero(mask))
+    dropped = sensor_data.attrs.get("dropped", 0)
+    sensor_data = _index_by_date(sensor_data)
+    sensor_data.attrs["detid"] = id
+    sensor_data.attrs["quality"] = repr(quality)
+    sensor_data.attrs["dropped"] = dropped
+    sensor_data.attrs["source"] = os.path.abspath(source)
+    sensor_data.attrs["mtime"] = _source_mtime(source)
+    add_rows(len(sensor_data))
+    return sensor_data
+
+@span("read_from_ids")
+def read_from_ids(ids, daytype, dir, n_workers=None, use_cache=True, return_failed=False, registry=None, quality=None):
     """Reading csv files for a list of sensor ids
+    Sensors are read in parallel by a thread pool. The first read of a sensor converts its csv
+    into a columnar cache with parsed dates, later reads load the cache unless the csv has been
+    replaced or modified since.
+
     Args:
         - ids: list of ids
         - daytype: choose from {"workday", "weekend", "holiday"}
-        - dir: directory containing files
+        - dir: directory containing files, either dir/daytype/id.csv or dir/daytype/id/ with part files
+        - n_workers: number of threads, if None, use the default of ThreadPoolExecutor, min(32, number of cpus + 4)
+        - use_cache: whether to read from and write to the columnar cache
+        - return_failed: whether to also return the ids that could not be read, otherwise they are
+          reported in a single warning
+        - registry: if given, a registry.DetectorRegistry whose code of every sensor is kept in attrs["code"]
+        - quality: quality policy on the valid/suspect flags, "valid", "strict" or a dict (see
+          QUALITY_POLICIES). Failing rows are skipped while loading, their number is kept in
+          attrs["dropped"] (see quality_report). If None, every row is kept
 
     Returns:
-        - A dict with keys being id and value being corresponding dataframe
+        - A dict with keys being id and value being corresponding dataframe, sorted and indexed by date
+        - (if return_failed) A dict with keys being id and value being the reason of failure
     """
     data_dict = {}
-    for id in tqdm(ids, desc="Reading "+ daytype + " data"):
-        try:
-            sensor_data = pd.read_csv(os.path.join(dir,daytype,id+".csv"))
-            sensor_data["date"] = pd.to_datetime(sensor_data["date"], infer_datetime_format=True)
-            data_dict[id] = sensor_data
-        except:
-            pass
+    failed = {}
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = {executor.submit(_read_sensor, id, daytype, dir, use_cache, quality): id for id in ids}
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Reading "+ daytype + " data"):
+            id = futures[future]
+            try:
+                data_dict[id] = future.result()
+            except Exception as e:
+                failed[id] = type(e).__name__ + ": " + str(e)
+    # Keep the order of the given ids
+    data_dict = {id: data_dict[id] for id in ids if id in data_dict}
+    add_rows(sum(len(data) for data in data_dict.values()))
+    if registry is not None:
+        for id, code in zip(data_dict, registry.codes(list(data_dict))):
+            data_dict[id].attrs["code"] = int(code)
+    if return_failed:
+        return data_dict, failed
+    if failed:
+        reasons = "; ".join(id + " (" + reason + ")" for id, reason in list(failed.items())[:10])
+        more = ", ..." if len(failed) > 10 else ""
+        warnings.warn(str(len(failed)) + " of " + str(len(futures)) + " sensors could not be read: " + reasons + more, stacklevel=2)
     return data_dict
 
-def query(sensor_data, begin, end, scale):
+SCALES = ("hour", "day", "week", "month")
+
+def _stack(sensor_data, begin, end, with_complete, with_sensor=False, quality=None):
+    """Stack the rows of all sensors in [begin, end) into a single dataframe holding only the
+    columns needed for aggregation. If with_complete, a boolean column "complete" marks the
+    rows without any missing value in the original sensor dataframe. If with_sensor, an int32
+    column "sensor" holds the position of the sensor in sensor_data. Rows failing the quality
+    policy are left out.
+    """
+    names = ["date", "hour", "occ", "flow"]
+    columns = {name: [] for name in names + ["complete", "sensor"]}
+    for i, data in enumerate(sensor_data):
+        data = time_range(data, begin, end)
+        mask = _quality_mask(data, quality)
+        keep = slice(None) if mask is None else mask
+        for name in names:
+            columns[name].append(data[name].to_numpy()[keep])
+        if with_complete:
+            columns["complete"].append(data.notna().all(axis=1).to_numpy()[keep])
+        if with_sensor:
+            columns["sensor"].append(np.full(len(columns["date"][-1]), i, dtype=np.int32))
+    if not with_complete:
+        del columns["complete"]
+    if not with_sensor:
+        del columns["sensor"]
+    return pd.DataFrame({name: np.concatenate(values) for name, values in columns.items()})
+
+def _scale_key(stacked, scale):
+    """Vectorized group key of every stacked row for a scale"""
+    if scale == "hour":
+        return stacked["hour"]
+    elif scale == "day":
+        return stacked["date"]
+    elif scale == "week":
+        return stacked["date"].dt.isocalendar().week.astype(np.int64)
+    elif scale == "month":
+        return stacked["date"].dt.month
+    raise ValueError("Unknown scale " + str(scale) + ", choose from " + str(SCALES))
+
+def _aggregate(stacked, scale, by_sensor=False):
+    """Mean occupancy and flow of the stacked rows for a scale, per sensor if by_sensor"""
+    # Coarser scales only consider rows without missing values
+    if scale != "hour":
+        stacked = stacked[stacked["complete"].to_numpy()]
+    key = _scale_key(stacked, scale).rename("date" if scale == "day" else scale)
+    keys = [stacked["sensor"], key] if by_sensor else key
+    agg_data = stacked[["occ", "flow"]].groupby(keys).mean().reset_index()
+    return agg_data
+
+def _check_scales(scale):
+    """Scales of a query given a scale or a list of them, raises ValueError for unknown ones"""
+    scales = [scale] if isinstance(scale, str) else list(scale)
+    for s in scales:
+        if s not in SCALES:
+            raise ValueError("Unknown scale " + str(s) + ", choose from " + str(SCALES))
+    return scales
+
+def _by_scale(scale, aggregate):
+    """Answer a query for a scale or a list of them
+
+    Args:
+    - scale: {hour, day, week, month}, or a list of them
+    - aggregate: function of a scale giving its statistics
+
+    Returns:
+    - the statistics of scale, or a dict with keys being scale and value being corresponding
+      statistics if a list of scales is given
+    """
+    agg_data = {}
+    for s in _check_scales(scale):
+        with span("aggregate_" + s):
+            agg_data[s] = aggregate(s)
+    if isinstance(scale, str):
+        return agg_data[scale]
+    return agg_data
+
+@span("query")
+def query(sensor_data, begin, end, scale, quality=None, ids=None, source=None, daytype=None):
     """Query the aggregated data from the sensor data list in (begin, end) for a scale.
     The finest scale is hour. Could also choose "day", "week" and "month". For missing id, ignore it.
+    The sensors are stacked once and every scale is answered by a single grouped reduction.
+
+    Args:
+    - sensor_data: A list of sensor data, a rollup cube (see rollup.py) to answer from its partial aggregates,
+      or a partitioned dataset (see dataset.py) to scan from disk
+    - begin, end: datetime
+    - scale: {hour, day, week, month}, or a list of them
+    - quality: quality policy on the valid/suspect flags (see read_from_ids), failing rows are
+      left out of the aggregation. A rollup cube must have been built with the same policy (see
+      rollup.build_rollup)
+    - ids: list of sensor ids to consider, if None, use all sensors. Only for a rollup cube or a
+      partitioned dataset
+    - source: data source to consider. Only for a partitioned dataset, needed if it holds several sources
+    - daytype: daytype to consider. Only for a rollup cube or a partitioned dataset, needed if it
+      holds several daytypes
+
+    Returns:
+    - Statistics(a pd.DataFrame) on these sensors during a specific time range. If a list of
+      scales is given, a dict with keys being scale and value being corresponding statistics
+    """
+    from rollup import is_rollup, query_rollup
+    from dataset import PartitionedDataset
+    if is_rollup(sensor_data):
+        if quality is not None and sensor_data.attrs.get("quality", repr(None)) != repr(quality):
+            raise ValueError("The rollup cube was built with quality policy " + sensor_data.attrs.get("quality", repr(None))
+                             + ", build it with rollup.build_rollup(..., quality=" + repr(quality) + ")")
+        if source is not None:
+            raise ValueError("A rollup cube holds a single source, source is only for a partitioned dataset")
+        if daytype is None and sensor_data["daytype"].nunique() > 1:
+            raise ValueError("The rollup cube holds several daytypes, choose one with daytype")
+        return query_rollup(sensor_data, begin, end, scale, ids=ids, daytype=daytype)
+    if isinstance(sensor_data, PartitionedDataset):
+        if source is None and len(sensor_data.sources()) > 1:
+            raise ValueError("The dataset holds several sources, choose one with source")
+        if daytype is None and len(sensor_data.daytypes(source)) > 1:
+            raise ValueError("The dataset holds several daytypes, choose one with daytype")
+        return sensor_data.query(begin, end, scale, ids=ids, source=source, daytype=daytype, quality=quality)
+    if ids is not None or source is not None or daytype is not None:
+        raise ValueError("ids, source and daytype select the data of a rollup cube or a partitioned dataset, "
+                         "pass the wanted sensor data instead")
+
+    scales = _check_scales(scale)
+    with span("stack"):
+        stacked = _stack(sensor_data, begin, end, with_complete=any(s != "hour" for s in scales), quality=quality)
+        add_rows(len(stacked))
+    return _by_scale(scale, lambda s: _aggregate(stacked, s))
+
+def _values(array):
+    """Numpy values of an array, series or dataframe"""
+    if isinstance(array, (pd.Series, pd.DataFrame)):
+        return array.to_numpy(dtype=np.float64)
+    return np.asarray(array)
+
+def _like(result, array):
+    """Wrap a numpy result into the pandas type of array, if it is one"""
+    if isinstance(array, pd.DataFrame):
+        return pd.DataFrame(result, index=array.index, columns=array.columns)
+    if isinstance(array, pd.Series):
+        return pd.Series(result, index=array.index, name=array.name)
+    return result
+
+@span("query_by_sensor")
+def query_by_sensor(data_dict, begin, end, scale, metric="occ", registry=None, quality=None):
+    """Query the aggregated data of every sensor separately in (begin, end) for a scale,
+    with a single grouped reduction over all sensors instead of one query per sensor.
 
     Args:
-    - sensor_data: A list of sensor data
+    - data_dict: dict with keys being sensor id and value being sensor dataframe, as returned by read_from_ids
     - begin, end: datetime
     - scale: {hour, day, week, month}
+    - metric: {"occ", "flow"}
+    - registry: if given, a registry.DetectorRegistry, the index is then a categorical of the
+      sensor ids whose codes are the registry codes
+    - quality: quality policy on the valid/suspect flags (see read_from_ids), failing rows are
+      left out of the aggregation
 
     Returns:
-    - Statistics(a pd.Series) on these sensors during a specific time range
+    - pd.DataFrame indexed by sensor id with one column per hour/day/week/month. Sensors without
+      data in the time range have a row of nan
     """
-    if scale == "hour":
-        data_in_range = []
-        for data in sensor_data:
-            data_in_range.append(data[(data["date"] >= begin) & (data["date"] < end)].copy(deep=True).reset_index())
-        agg_data = pd.concat(data_in_range)
-        agg_data = agg_data.groupby(["hour"]).agg(occ = pd.NamedAgg(column="occ", aggfunc="mean"),
-                                                  flow = pd.NamedAgg(column="flow", aggfunc="mean")).reset_index()
-    elif scale == "day":
-        data_in_range = []
-        for data in sensor_data:
-            data_copy = data[(data["date"] >= begin) & (data["date"] < end)].copy(deep=True).reset_index() 
-            data_copy = data_copy.dropna()
-            data_in_range.append(data_copy)
-        agg_data = pd.concat(data_in_range)
-        agg_data = agg_data.groupby(["date"]).agg(occ = pd.NamedAgg(column="occ", aggfunc="mean"),
-                                                  flow = pd.NamedAgg(column="flow", aggfunc="mean")).reset_index()
-    elif scale == "week":
-        data_in_range = []
-        for data in sensor_data:
-            data_copy = data[(data["date"] >= begin) & (data["date"] < end)].copy(deep=True).reset_index()
-            data_copy["week"] = data_copy["date"].apply(lambda x: x.isocalendar().week)
-            data_copy = data_copy.dropna()
-            data_in_range.append(data_copy)
-        agg_data = pd.concat(data_in_range)
-        agg_data = agg_data.groupby(["week"]).agg(occ = pd.NamedAgg(column="occ", aggfunc="mean"),
-                                                  flow = pd.NamedAgg(column="flow", aggfunc="mean")).reset_index()
-                      
-    elif scale == "month":
-        data_in_range = []
-        for data in sensor_data:
-            data_copy = data[(data["date"] >= begin) & (data["date"] < end)].copy(deep=True).reset_index()
-            data_copy["month"] = data_copy["date"].apply(lambda x: x.month)
-            data_copy = data_copy.dropna()
-            data_in_range.append(data_copy)
-        agg_data = pd.concat(data_in_range)
-        agg_data = agg_data.groupby(["month"]).agg(occ = pd.NamedAgg(column="occ", aggfunc="mean"),
-                                                  flow = pd.NamedAgg(column="flow", aggfunc="mean")).reset_index()
-    return agg_data         
-
-def relative(array):
+    if scale not in SCALES:
+        raise ValueError("Unknown scale " + str(scale) + ", choose from " + str(SCALES))
+    ids = list(data_dict.keys())
+    with span("stack"):
+        stacked = _stack(list(data_dict.values()), begin, end, with_complete=scale != "hour", with_sensor=True, quality=quality)
+        add_rows(len(stacked))
+    with span("aggregate_" + scale):
+        agg_data = _aggregate(stacked, scale, by_sensor=True)
+    table = agg_data.pivot(index="sensor", columns="date" if scale == "day" else scale, values=metric)
+    table = table.reindex(np.arange(len(ids)))
+    if registry is None:
+        table.index = pd.Index(np.asarray(ids, dtype=object), name="detid")
+    else:
+        table.index = pd.CategoricalIndex(registry.categorical(ids), name="detid")
+    return table
+
+def quality_report(data_dict, quality=None, begin=None, end=None):
+    """Number of rows of every sensor dropped by quality policies
+
+    Args:
+    - data_dict: dict with keys being sensor id and value being sensor dataframe, as returned by read_from_ids
+    - quality: quality policy to evaluate on the loaded rows, if None, only report what was dropped at load time
+    - begin, end: datetime, time range of the loaded rows to evaluate, if None, all rows
+
+    Returns:
+    - pd.DataFrame indexed by sensor id with columns dropped_at_load, rows (loaded rows in range)
+      and failing (loaded rows in range failing quality)
+    """
+    report = {"dropped_at_load": [], "rows": [], "failing": []}
+    for data in data_dict.values():
+        if begin is not None or end is not None:
+            data = time_range(data, begin if begin is not None else pd.Timestamp.min, end if end is not None else pd.Timestamp.max)
+        mask = _quality_mask(data, quality)
+        report["dropped_at_load"].append(data.attrs.get("dropped", 0))
+        report["rows"].append(len(data))
+        report["failing"].append(0 if mask is None else int(len(mask) - np.count_nonzero(mask)))
+    return pd.DataFrame(report, index=pd.Index(list(data_dict.keys()), name="detid"))
+
+def relative(array, axis=None, out=None):
     """Get the relative values of an array, i.e., every element sums up to 1
     nan values are treated with np.nansum(), i.e., ignored
 
     Args:
-    - array: numpy array
+    - array: numpy array, pd.Series or pd.DataFrame
+    - axis: axis along which values sum up to 1, e.g. -1 for an array of profiles of shape
+      (sensor, time). If None, over the whole array
+    - out: numpy array to write the result into, avoids allocating a new one
 
     Returns:
-    - relative values
+    - relative values, of the same type as array
     """
-    assert len(array.shape) == 1
-    return array / np.nansum(array)
+    values = _values(array)
+    total = np.nansum(values, axis=axis, keepdims=True)
+    return _like(np.divide(values, total, out=out), array)
 
-def normalize(array):
+def normalize(array, axis=None, out=None, skipna=None):
     """
     Args:
-    - array: np.array
+    - array: numpy array, pd.Series or pd.DataFrame
+    - axis: axis along which values are normalized, e.g. -1 for an array of profiles of shape
+      (sensor, time). If None, over the whole array
+    - out: numpy array to write the result into, avoids allocating a new one
+    - skipna: whether to ignore nan values when computing mean and std. If None, they are
+      ignored for pandas objects and not for numpy arrays, like pandas and numpy do
 
     Returns:
-    - normalized values
+    - normalized values, of the same type as array
     """
-    assert len(array.shape) == 1
-    return (array - np.mean(array)) / np.std(array)
-   
-def compute_yoy(before, after):
+    values = _values(array)
+    if skipna is None:
+        skipna = isinstance(array, (pd.Series, pd.DataFrame))
+    mean, std = (np.nanmean, np.nanstd) if skipna else (np.mean, np.std)
+    result = np.subtract(values, mean(values, axis=axis, keepdims=True), out=out)
+    np.divide(result, std(values, axis=axis, keepdims=True), out=result)
+    return _like(result, array)
+
+def compute_yoy(before, after, out=None):
     """ Compute year over year increase/decrease percentage
+    Inputs are broadcast against each other, the ratio is nan where before is 0.
+
     Args:
-    - before: scalar or numpy array
-    - after: scalar or numpy array
+    - before: scalar, numpy array, pd.Series or pd.DataFrame
+    - after: scalar, numpy array, pd.Series or pd.DataFrame
+    - out: numpy array to write the result into, for numpy inputs
 
     Returns:
     - ratio: increase/decrease percentage
     """
-    assert type(before) == type(after)
-    if type(before) == np.ndarray:
-        assert len(before) == len(after)
+    if isinstance(before, (pd.Series, pd.DataFrame)) or isinstance(after, (pd.Series, pd.DataFrame)):
+        if isinstance(before, (pd.Series, pd.DataFrame)):
+            denominator = before.where(before != 0)
+        else:
+            denominator = np.where(np.asarray(before) != 0, before, np.nan)
+        return (after - before) / denominator
 
-    return (after - before) / before
+    before = np.asarray(before, dtype=np.float64)
+    after = np.asarray(after, dtype=np.float64)
+    zero = before == 0
+    if out is None:
+        out = np.empty(np.broadcast_shapes(before.shape, after.shape))
+    np.subtract(after, before, out=out)
+    np.divide(out, before, out=out, where=~zero)
+    np.copyto(out, np.nan, where=zero)
+    return out[()]
 
 # Testing 
 if __name__ == "__main__":
@@ -0,0 +1,280 @@
+import os
+import re
+import json
+import time
+import hashlib
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from ingest import ingest_canton, ingest_astra, split_city_year, convert_vehicles, DAYTYPES, VEHICLE_SOURCES
+from utils import _load_frame
+from rollup import build_rollup, merge_rollups, save_rollup, load_rollup
+
+"""
+Incremental ingestion of newly arriving raw files.
+
+Raw files are recognized by their name (see README.md): canton files are named by 10 digits
+(e.g. 1888210929), astra files <id>_<YYYY-MM>.csv and city files Zurich_<YYYY>_raw2.csv. A
+manifest in the output directory records size, modification time, content hash, detectors and
+months of every processed file, so a pass only processes new and changed files:
+- the files are ingested in parallel into out_dir/canton_vehicles, out_dir/astra_vehicles and
+  out_dir/city (see ingest.py)
+- the months of the files are converted into intervals in out_dir/canton and out_dir/astra, for
+  the affected canton and astra detectors
+- the buckets of these detectors and months in the rollup cube out_dir/<source>/rollup.npz are
+  rebuilt from the rewritten files only
+
+Every step replaces what a previous run wrote for the same file or sensor, so a pass can be
+repeated. The manifest is rewritten atomically after each file; a file whose derived steps did
+not complete, e.g. because of a crash, is finished by the next pass.
+"""
+
+MANIFEST = ".ingest_manifest.json"
+PATTERNS = {
+    "canton": re.compile(r"^\d{10}$"),
+    "astra": re.compile(r"^\d+_\d{4}-\d{2}\.csv$"),
+    "city": re.compile(r"^Zurich_\d{4}_raw2\.csv$"),
+}
+
+def classify_file(path):
+    """Source of a raw file recognized by its name, None for other files"""
+    name = os.path.basename(path)
+    for source, pattern in PATTERNS.items():
+        if pattern.match(name):
+            return source
+    return None
+
+def file_hash(path, block_size=2**20):
+    """SHA-1 of the content of a file"""
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def load_manifest(out_dir):
+    """Manifest of the processed files, a dict with keys being absolute path"""
+    path = os.path.join(out_dir, MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_manifest(manifest, out_dir):
+    """Write the manifest through a temporary file, such that a crash never leaves half a manifest"""
+    os.makedirs(out_dir, exist_ok=True)
+    path = os.path.join(out_dir, MANIFEST)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+def find_changes(raw_dir, manifest):
+    """Raw files under raw_dir that are new or changed since they were recorded in the manifest.
+    Files whose size and modification time are unchanged are not read, files whose content hash
+    is unchanged are not reported.
+
+    Args:
+    - raw_dir: directory searched recursively
+    - manifest: see load_manifest
+
+    Returns:
+    - A dict with keys being absolute path and value being a dict with keys source, size, mtime
+      and hash (None if not computed yet)
+    """
+    changes = {}
+    to_hash = []
+    for dirpath, _, names in os.walk(raw_dir):
+        for name in sorted(names):
+            path = os.path.abspath(os.path.join(dirpath, name))
+            source = classify_file(path)
+            if source is None:
+                continue
+            stat = os.stat(path)
+            entry = dict(source=source, size=stat.st_size, mtime=stat.st_mtime, hash=None)
+            recorded = manifest.get(path)
+            if recorded is None or recorded["size"] != entry["size"]:
+                changes[path] = entry
+            elif recorded["mtime"] != entry["mtime"]:
+                to_hash.append((path, entry))
+    # Touched files are only changed if their content is
+    with ThreadPoolExecutor() as executor:
+        for (path, entry), h in zip(to_hash, executor.map(file_hash, [path for path, _ in to_hash])):
+            entry["hash"] = h
+            if h != manifest[path]["hash"]:
+                changes[path] = entry
+            else:
+                manifest[path]["mtime"] = entry["mtime"]
+    return changes
+
+def _vehicle_months(vehicle_dir, detectors, source, stem):
+    """Months "YYYY-MM" of the vehicles ingested from a raw file, read from the time column of its parts"""
+    months = set()
+    for detid in detectors:
+        part_dir = os.path.join(vehicle_dir, detid)
+        for name in os.listdir(part_dir):
+            if name == stem + ".npz" or name.startswith(stem + "-"):
+                with np.load(os.path.join(part_dir, name), allow_pickle=False) as f:
+                    months.update(np.unique(f[VEHICLE_SOURCES[source]["time"]].astype("datetime64[M]")).astype(str))
+    return sorted(months)
+
+def _ingest_file(source, path, out_dir):
+    """Ingest a raw file, run in the worker processes of sync
+
+    Returns:
+    - content hash of the file
+    - list of the affected detector ids
+    - list of the months "YYYY-MM" of the data of the file
+    """
+    h = file_hash(path)
+    stem = os.path.splitext(os.path.basename(path))[0]
+    if source in ["canton", "astra"]:
+        vehicle_dir = os.path.join(out_dir, source + "_vehicles")
+        ingest = ingest_canton if source == "canton" else ingest_astra
+        detectors = list(ingest(path, vehicle_dir).keys())
+        months = _vehicle_months(vehicle_dir, detectors, source, stem)
+    else:
+        city_dir = os.path.join(out_dir, "city")
+        split_city_year(path, city_dir, n_threads=1)
+        detectors = sorted(set(entry.name for daytype in DAYTYPES if os.path.isdir(os.path.join(city_dir, daytype))
+                               for entry in os.scandir(os.path.join(city_dir, daytype))
+                               if os.path.exists(os.path.join(entry.path, stem + ".npz"))))
+        # A city file holds a year
+        year = re.search(r"\d{4}", stem).group(0)
+        months = [year + "-" + str(month).zfill(2) for month in range(1, 13)]
+    return h, detectors, months
+
+def refresh_rollup(store_dir, months, names=None, batch_size=64):
+    """Rebuild the buckets of some sensors and months in the rollup cube store_dir/rollup.npz from
+    the per-sensor store, reading only the part files holding these months. The other buckets are kept.
+
+    Args:
+    - store_dir: directory of the per-sensor store, as read by read_from_ids
+    - months: dict with keys being sensor id and value being the list of months "YYYY-MM" to
+      rebuild, or None to rebuild the whole history of the sensor
+    - names: dict with keys being sensor id and value being the names of the part files holding
+      the months, e.g. the yearly parts of the city data. For sensors not in names, the monthly
+      parts <YYYY-MM>.npz written by convert_vehicles
+    - batch_size: number of sensors held in memory at once
+    """
+    names = {} if names is None else names
+    cube_path = os.path.join(store_dir, "rollup.npz")
+    cube = load_rollup(cube_path)
+    sensors = cube["sensor"].astype(str).to_numpy()
+    cube_months = cube["date"].to_numpy().astype("datetime64[M]").astype(str)
+    pairs = pd.MultiIndex.from_tuples([(detid, month) for detid, detid_months in months.items()
+                                       if detid_months is not None for month in detid_months])
+    stale = np.isin(sensors, [detid for detid, detid_months in months.items() if detid_months is None])
+    if len(pairs) > 0:
+        stale |= pd.MultiIndex.from_arrays([sensors, cube_months]).isin(pairs)
+    cubes = [cube[~stale]]
+
+    detectors = list(months)
+    for daytype in DAYTYPES:
+        if not os.path.isdir(os.path.join(store_dir, daytype)):
+            continue
+        for i in range(0, len(detectors), batch_size):
+            data_dict = {}
+            for detid in detectors[i:i + batch_size]:
+                detector_dir = os.path.join(store_dir, daytype, detid)
+                if not os.path.isdir(detector_dir):
+                    continue
+                detid_months = months[detid]
+                if detid_months is None:
+                    part_names = [name for name in os.listdir(detector_dir) if name.endswith(".npz")]
+                else:
+                    part_names = names.get(detid, [month + ".npz" for month in detid_months])
+                frames = [_load_frame(os.path.join(detector_dir, name)) for name in sorted(part_names)
+                          if os.path.exists(os.path.join(detector_dir, name))]
+                if len(frames) == 0:
+                    continue
+                data = pd.concat(frames, ignore_index=True)
+                if detid_months is not None:
+                    data = data[np.isin(data["date"].to_numpy().astype("datetime64[M]").astype(str), list(detid_months))]
+                data_dict[detid] = data
+            cubes.append(build_rollup(data_dict, daytype))
+    save_rollup(merge_rollups(cubes), cube_path)
+
+def sync(raw_dir, out_dir, n_workers=None, interval=180):
+    """Process the new and changed raw files once, see the module documentation
+
+    Args:
+    - raw_dir: directory containing the raw files, searched recursively
+    - out_dir: output directory, also holding the manifest
+    - n_workers: number of processes, if None, use the number of cpus
+    - interval: length of the intervals canton and astra vehicles are converted into, in seconds
+
+    Returns:
+    - A dict with keys being path and value being "done" or the reason of failure
+    """
+    manifest = load_manifest(out_dir)
+    changes = find_changes(raw_dir, manifest)
+    status = {}
+
+    # Ingest, every finished file is recorded at once
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {executor.submit(_ingest_file, entry["source"], path, out_dir): path for path, entry in changes.items()}
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Ingesting new files"):
+            path = futures[future]
+            try:
+                h, detectors, months = future.result()
+            except Exception as e:
+                status[path] = type(e).__name__ + ": " + str(e)
+                continue
+            # Months of a previous version of the file are rebuilt too, they may have lost data
+            previous = manifest.get(path, {})
+            if previous.get("stage") == "done" and previous.get("months") is not None:
+                months = sorted(set(months) | set(previous["months"]))
+            manifest[path] = dict(changes[path], hash=h, detectors=detectors, months=months, stage="ingested")
+            save_manifest(manifest, out_dir)
+
+    # Derived steps of every file not done yet, including files left over by an interrupted pass
+    pending = [path for path, entry in manifest.items() if entry.get("stage") != "done"]
+    # Months to rebuild per source and detector, None for the whole history (files recorded without months)
+    months = {source: {} for source in PATTERNS}
+    names = {source: {} for source in PATTERNS}
+    for path in pending:
+        entry = manifest[path]
+        touched = months[entry["source"]]
+        for detid in entry["detectors"]:
+            if entry.get("months") is None or (detid in touched and touched[detid] is None):
+                touched[detid] = None
+            else:
+                touched[detid] = sorted(set(touched.get(detid, [])) | set(entry["months"]))
+            if entry["source"] == "city":
+                names["city"].setdefault(detid, []).append(os.path.splitext(os.path.basename(path))[0] + ".npz")
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(convert_vehicles, os.path.join(out_dir, source + "_vehicles", detid), os.path.join(out_dir, source),
+                                   source, interval, 2.0, detid_months)
+                   for source in ["canton", "astra"] for detid, detid_months in months[source].items()]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Converting vehicles"):
+            future.result()
+    for source, touched in months.items():
+        if len(touched) > 0:
+            refresh_rollup(os.path.join(out_dir, source), touched, names[source])
+
+    for path in pending:
+        manifest[path]["stage"] = "done"
+        status[path] = "done"
+    save_manifest(manifest, out_dir)
+    return status
+
+def watch(raw_dir, out_dir, period=60, n_workers=None, interval=180):
+    """Process new and changed raw files every period seconds, until interrupted
+
+    Args:
+    - raw_dir: directory containing the raw files, searched recursively
+    - out_dir: output directory
+    - period: seconds between two passes
+    - n_workers: number of processes, if None, use the number of cpus
+    - interval: length of the intervals canton and astra vehicles are converted into, in seconds
+    """
+    while True:
+        status = sync(raw_dir, out_dir, n_workers, interval)
+        for path, result in status.items():
+            print(path, result, sep="\t")
+        time.sleep(period)
+
+# Testing
+if __name__ == "__main__":
+    print(sync("./raw_data", "./preprocessed_data"))